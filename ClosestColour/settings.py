@@ -10,15 +10,25 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 from typing import List
 
+from PIL import Image, features
+
+from closest_colour.admission import ConcurrencyLimiter
 from closest_colour.colours import (
     LabKDTreeColourMatcher,
     SRGBKDTreeColourMatcher,
     webcolors_to_ours,
 )
-from closest_colour.images import KMeansImageColourSummariser, MeanImageColourSummariser
+from closest_colour.images import (
+    KMeansImageColourSummariser,
+    MeanImageColourSummariser,
+    ProgressiveImageColourSummariser,
+    QuantizeImageColourSummariser,
+)
+from closest_colour.profiling import RequestProfiler
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -158,6 +168,74 @@ DEFAULT_COLOUR_SPACE = "srgb"
 IMAGE_SUMMARISERS = {
     "mean": MeanImageColourSummariser(),
     "kmeans": KMeansImageColourSummariser(),
+    # k-means at 16x16, moving up through 64x64, 200x200 and 1000x1000 only when the answer is ambiguous;
+    # add None to the tiers to finally try the full-size image, if you can afford it
+    "progressive": ProgressiveImageColourSummariser(tiers=(16, 64, 200, 1000)),
+    # Pillow's built in quantizers, which work on the 8-bit image in C rather than on floats in NumPy;
+    # see `python manage.py benchmark_summarisers` for how they compare with k-means
+    "mediancut": QuantizeImageColourSummariser(Image.Quantize.MEDIANCUT),
+    "octree": QuantizeImageColourSummariser(Image.Quantize.FASTOCTREE),
 }
 
+# libimagequant is an optional part of Pillow, so only offer it if this Pillow was built with it
+if features.check_feature("libimagequant"):
+    IMAGE_SUMMARISERS["libimagequant"] = QuantizeImageColourSummariser(Image.Quantize.LIBIMAGEQUANT)
+
 DEFAULT_IMAGE_SUMMARISER = "kmeans"
+
+# Admission control for the match endpoint.
+#
+# Each user is rate limited by DRF's throttling, which responds with 429 and Retry-After.
+# On top of that, fetches and summarise jobs are each limited to a number of concurrent jobs per
+# process. Once a new request would have to queue for longer than the latency budget, it is
+# rejected straight away with 503 and Retry-After, rather than piling up behind the others until
+# the client times out. Current queue depths are reported by the /colours/admission endpoint.
+REST_FRAMEWORK = {
+    "DEFAULT_THROTTLE_RATES": {
+        "match_colour": "60/minute",
+        "palette_coverage": "10/minute",
+    },
+}
+
+# The throttles keep each user's request history in the "throttle" cache. The default cache is local
+# memory, which is per process, so with several gunicorn/uvicorn workers each user would get the rate
+# once per worker. A file based cache is shared by every worker on this machine; if the app runs on
+# several machines, point this at something they all share, e.g. Django's RedisCache.
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "throttle": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": BASE_DIR / "throttle_cache",
+    },
+}
+
+# fetching is IO bound, so allow plenty of concurrent fetches
+FETCH_LIMITER = ConcurrencyLimiter(max_concurrency=32, latency_budget=5.0, initial_service_time=0.5)
+
+FETCH_TIMEOUT = 10.0
+
+# summarising is CPU bound, so there is no point running more jobs at once than we have cores
+SUMMARISE_LIMITER = ConcurrencyLimiter(
+    max_concurrency=os.cpu_count() or 1, latency_budget=2.0, initial_service_time=0.5
+)
+
+# The coverage endpoint works on images scaled down to at most this many pixels along their longest
+# side, unless asked for something else (or "full")
+DEFAULT_COVERAGE_MAX_SIZE = 1000
+
+# number of threads each coverage request can use to match pixels; -1 means one per core
+COVERAGE_WORKERS = -1
+
+# Coverage jobs have their own limiter rather than sharing SUMMARISE_LIMITER. Each one already uses
+# every core (see COVERAGE_WORKERS), so running one per core would oversubscribe the CPU. A full-size
+# job can take over a second, and sharing a moving average with the match endpoint's fast jobs would
+# make that shed match requests it could easily serve.
+COVERAGE_LIMITER = ConcurrencyLimiter(max_concurrency=1, latency_budget=5.0, initial_service_time=1.0)
+
+# Opt-in profiling of real requests to the match endpoint. A request is profiled if picked at random
+# according to sample_rate, or if a staff user sends an X-Profile header (X-Profile: memory also
+# traces memory allocations). Dumps go to profiles/ and only the newest max_dumps are kept.
+# Set to None to turn off entirely.
+REQUEST_PROFILER = RequestProfiler(BASE_DIR / "profiles", sample_rate=0.0, header="X-Profile", max_dumps=100)
@@ -0,0 +1,93 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Union
+
+
+class Overloaded(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__(f"overloaded, retry after {retry_after:.2f}s")
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self) -> str:
+        # Retry-After only allows whole seconds
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+# Bounds the number of jobs of one kind (e.g. image fetches) running at once across all requests
+# served by this process. Rather than letting requests queue indefinitely behind a saturated resource,
+# the expected queue wait is estimated from the number of waiting jobs and a moving average of how
+# long each job takes. If a new arrival would have to wait longer than the latency budget, Overloaded
+# is raised straight away, so the client can back off while the requests we did accept finish in time.
+class ConcurrencyLimiter:
+    def __init__(
+        self, max_concurrency: int, latency_budget: float, initial_service_time: float, smoothing: float = 0.2
+    ):
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+        self.max_concurrency = max_concurrency
+        self.latency_budget = latency_budget
+        self.smoothing = smoothing
+        self.mean_service_time = initial_service_time
+        self.in_flight = 0
+        self.waiting = 0
+        self._condition = threading.Condition()
+
+    def _estimated_wait(self, queued_ahead: int) -> float:
+        # must be called with the condition held
+        if self.in_flight < self.max_concurrency and queued_ahead == 0:
+            return 0.0
+        # every max_concurrency jobs ahead of us in the queue costs roughly one service time
+        return (queued_ahead // self.max_concurrency + 1) * self.mean_service_time
+
+    def estimated_wait(self) -> float:
+        with self._condition:
+            return self._estimated_wait(self.waiting)
+
+    def depth(self) -> Dict[str, Union[int, float]]:
+        with self._condition:
+            return {
+                "in_flight": self.in_flight,
+                "waiting": self.waiting,
+                "max_concurrency": self.max_concurrency,
+                "mean_service_time": self.mean_service_time,
+                "estimated_wait": self._estimated_wait(self.waiting),
+            }
+
+    def check(self) -> None:
+        # raises Overloaded if a job arriving now would be shed, without taking a slot, so callers can skip
+        # work they'd only throw away (e.g. fetching an image nobody has time to summarise)
+        estimated_wait = self.estimated_wait()
+        if estimated_wait > self.latency_budget:
+            raise Overloaded(estimated_wait)
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        with self._condition:
+            estimated_wait = self._estimated_wait(self.waiting)
+            if estimated_wait > self.latency_budget:
+                raise Overloaded(estimated_wait)
+            deadline = time.monotonic() + self.latency_budget
+            self.waiting += 1
+            try:
+                while self.in_flight >= self.max_concurrency:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        # our estimate was too optimistic; give up rather than blow the budget
+                        raise Overloaded(self._estimated_wait(self.waiting))
+                    self._condition.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.in_flight += 1
+
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            with self._condition:
+                self.in_flight -= 1
+                self.mean_service_time += self.smoothing * (elapsed - self.mean_service_time)
+                self._condition.notify()
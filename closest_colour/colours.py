@@ -1,8 +1,10 @@
 import re
 from abc import ABC, abstractmethod
-from typing import Dict, Tuple, Type
+from typing import Callable, Dict, List, Tuple, Type
 
+import numpy
 import webcolors
+from colormath import color_constants
 from colormath.color_conversions import convert_color
 from colormath.color_objects import ColorBase, LabColor, sRGBColor
 from scipy.spatial import KDTree
@@ -21,6 +23,28 @@ def webcolors_to_ours(source: Dict[str, str] = webcolors.CSS3_NAMES_TO_HEX) -> D
     return our_colours
 
 
+def srgb_array_to_lab(srgb: numpy.ndarray) -> numpy.ndarray:
+    # Does the same as colormath's convert_color(sRGBColor, LabColor), but for a whole (..., 3) array
+    # of colours at once: sRGB -> linear RGB -> XYZ -> Lab, all relative to the D65 white point.
+    # Converting pixels one at a time with colormath would take minutes for a large image.
+    linear = numpy.where(srgb <= 0.04045, srgb / 12.92, ((srgb + 0.055) / 1.055) ** 2.4)
+    xyz = linear @ sRGBColor.conversion_matrices["rgb_to_xyz"].T
+    white = numpy.asarray(color_constants.ILLUMINANTS["2"]["d65"])
+    scaled = xyz / white
+    f = numpy.where(scaled > color_constants.CIE_E, numpy.cbrt(scaled), 7.787 * scaled + 16.0 / 116.0)
+    lab = numpy.empty_like(f)
+    lab[..., 0] = 116.0 * f[..., 1] - 16.0
+    lab[..., 1] = 500.0 * (f[..., 0] - f[..., 1])
+    lab[..., 2] = 200.0 * (f[..., 1] - f[..., 2])
+    return lab
+
+
+SRGB_ARRAY_CONVERSIONS: Dict[Type[ColorBase], Callable[[numpy.ndarray], numpy.ndarray]] = {
+    sRGBColor: lambda srgb: srgb,
+    LabColor: srgb_array_to_lab,
+}
+
+
 # In [30]: timeit.timeit(lambda: colours.nearest_colour_name(sRGBColor(random.random(), random.random(), random.random()
 #    ...: )), number=100000) / 100000.0
 # Out[30]: 6.836906400043517e-05
@@ -41,6 +65,20 @@ class ColourMatcher(ABC):
     def nearest(self, target: ColorBase) -> Tuple[str, float]:  # pragma: nocover
         pass
 
+    @abstractmethod
+    def nearest_k(self, target: ColorBase, k: int) -> List[Tuple[str, float]]:  # pragma: nocover
+        pass
+
+    # For matching many colours at once, e.g. every pixel of an image: takes an (n, 3) array of sRGB
+    # colours, and returns an array of distances and an array of indices into self.names.
+    names: List[str]
+
+    @abstractmethod
+    def nearest_srgb_array(
+        self, srgb: numpy.ndarray, workers: int = 1
+    ) -> Tuple[numpy.ndarray, numpy.ndarray]:  # pragma: nocover
+        pass
+
 
 class KDTreeColourMatcher(ColourMatcher):
     def __init__(self, colours: Dict[str, ColorBase], colour_type: Type[ColorBase]):
@@ -48,11 +86,44 @@ class KDTreeColourMatcher(ColourMatcher):
         self.colours_list = [(name, convert_color(colour, colour_type)) for name, colour in colours.items()]
         self.colours_array = [ColourMatcher.colour_to_floats(colour, colour_type) for name, colour in self.colours_list]
         self.kdtree = KDTree(self.colours_array)
+        first_index_of_colour: Dict[Tuple[float, ...], int] = {}
+        self.canonical_indices = [
+            first_index_of_colour.setdefault(tuple(floats), index) for index, floats in enumerate(self.colours_array)
+        ]
+        self.duplicate_count = len(self.colours_array) - len(first_index_of_colour)
+        self.names = [name for name, colour in self.colours_list]
+        if colour_type not in SRGB_ARRAY_CONVERSIONS:
+            raise ValueError(f"can't convert arrays of sRGB colours to {colour_type.__name__}")
+        self.from_srgb_array = SRGB_ARRAY_CONVERSIONS[colour_type]
 
     def nearest(self, target: ColorBase) -> Tuple[str, float]:
         distance, index = self.kdtree.query(ColourMatcher.colour_to_floats(target, self.colour_type), k=1)
         return self.colours_list[index][0], distance
 
+    def nearest_k(self, target: ColorBase, k: int) -> List[Tuple[str, float]]:
+        # palettes can have several names for the same colour (e.g. CSS has both gray and grey), which
+        # would always come out as equally near; we only return the first name of each distinct colour,
+        # so have to ask for enough extra neighbours to make up for any duplicates
+        query_k = min(k + self.duplicate_count, len(self.colours_list))
+        # asking for a list of k values means we always get arrays back, even for k=1
+        distances, indices = self.kdtree.query(
+            ColourMatcher.colour_to_floats(target, self.colour_type), k=range(1, query_k + 1)
+        )
+        seen = set()
+        results = []
+        for distance, index in zip(distances, indices):
+            canonical_index = self.canonical_indices[index]
+            if canonical_index not in seen:
+                seen.add(canonical_index)
+                results.append((self.colours_list[canonical_index][0], distance))
+        return results[:k]
+
+    def nearest_srgb_array(self, srgb: numpy.ndarray, workers: int = 1) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        # one query for the whole array, which the KD-tree can split across several cores (-1 for all of them)
+        distances, indices = self.kdtree.query(self.from_srgb_array(srgb), k=1, workers=workers)
+        # like nearest_k, always report duplicate colours under their first name
+        return distances, numpy.asarray(self.canonical_indices)[indices]
+
 
 class LabKDTreeColourMatcher(KDTreeColourMatcher):
     def __init__(self, colours: Dict[str, ColorBase]):
@@ -0,0 +1,94 @@
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import numpy
+from PIL import Image
+
+from .colours import ColourMatcher
+from .images import SOURCE_MODES, convert_to_srgb
+
+# Rather than one summary colour, work out how much of an image is closest to each colour in the
+# palette, e.g. to see what fraction of an artwork will be printed with each ink. Matching pixels
+# one at a time with ColourMatcher.nearest would take minutes for a large image, so instead the image
+# is matched a strip of rows at a time, with one batched query per strip. Only the distinct colours in
+# each strip are converted to floats, so memory use beyond the decoded 8-bit image stays bounded,
+# however large the image is. For the same reason, colour management (see images.py) is applied to
+# one strip at a time, after the image has been scaled down.
+
+DEFAULT_CHUNK_PIXELS = 256 * 1024
+
+
+@dataclass
+class PaletteCoverage:
+    width: int
+    height: int
+    # fraction of pixels closest to each palette colour, for colours with any pixels at all
+    coverage: Dict[str, float]
+    mean_distance: float
+    max_distance: float
+    # distances from each pixel to its nearest palette colour, as counts in bins between the edges
+    distance_bin_edges: List[float]
+    distance_counts: List[int]
+    # pixels further than the last bin edge from any palette colour
+    distance_overflow: int
+
+
+def palette_coverage(
+    pil_image: Image.Image,
+    matcher: ColourMatcher,
+    distance_bin_edges: numpy.ndarray,
+    max_size: Optional[int] = None,
+    chunk_pixels: int = DEFAULT_CHUNK_PIXELS,
+    workers: int = -1,
+    icc_profile: Optional[bytes] = None,
+) -> PaletteCoverage:
+    # pil_image is normally as returned by open_image, with icc_profile the profile that came with it
+    if pil_image.mode not in SOURCE_MODES:
+        pil_image = pil_image.convert("RGB")
+    if max_size is not None and max(pil_image.size) > max_size:
+        # unlike the summarisers, keep the aspect ratio, so each pixel covers the same area of the image
+        scale = max_size / max(pil_image.size)
+        size = (max(1, round(pil_image.width * scale)), max(1, round(pil_image.height * scale)))
+        pil_image = pil_image.resize(size, resample=Image.LANCZOS, reducing_gap=3.0)
+
+    width, height = pil_image.size
+    rows_per_chunk = max(1, chunk_pixels // width)
+    counts = numpy.zeros(len(matcher.names), dtype=numpy.int64)
+    distance_counts = numpy.zeros(len(distance_bin_edges) - 1, dtype=numpy.int64)
+    distance_overflow = 0
+    distance_sum = 0.0
+    max_distance = 0.0
+    for top in range(0, height, rows_per_chunk):
+        strip = convert_to_srgb(pil_image.crop((0, top, width, min(top + rows_per_chunk, height))), icc_profile)
+        # most images use far fewer distinct colours than they have pixels, so only match each distinct
+        # colour once, and weight its results by the number of pixels it covers
+        rgb = numpy.asarray(strip).reshape(-1, 3).astype(numpy.uint32)
+        packed_colours, pixel_counts = numpy.unique(
+            (rgb[:, 0] << 16) | (rgb[:, 1] << 8) | rgb[:, 2], return_counts=True
+        )
+        srgb = numpy.stack([(packed_colours >> 16) & 0xFF, (packed_colours >> 8) & 0xFF, packed_colours & 0xFF], axis=1)
+        distances, indices = matcher.nearest_srgb_array(srgb / 255.0, workers=workers)
+        counts += numpy.bincount(indices, weights=pixel_counts, minlength=len(counts)).astype(numpy.int64)
+        distance_counts += numpy.histogram(distances, bins=distance_bin_edges, weights=pixel_counts)[0].astype(
+            numpy.int64
+        )
+        distance_overflow += int(pixel_counts[distances > distance_bin_edges[-1]].sum())
+        distance_sum += float((distances * pixel_counts).sum())
+        max_distance = max(max_distance, float(distances.max()))
+
+    pixels = width * height
+    coverage = {
+        matcher.names[index]: int(counts[index]) / pixels
+        for index in numpy.argsort(-counts, kind="stable")
+        if counts[index] > 0
+    }
+    return PaletteCoverage(
+        width=width,
+        height=height,
+        coverage=coverage,
+        mean_distance=distance_sum / pixels,
+        max_distance=max_distance,
+        distance_bin_edges=[float(edge) for edge in distance_bin_edges],
+        distance_counts=[int(count) for count in distance_counts],
+        distance_overflow=distance_overflow,
+    )
@@ -1,14 +1,139 @@
+import hashlib
+import threading
+import time
 from abc import ABC, abstractmethod
-from io import IOBase
-from typing import Optional, Union
+from collections import OrderedDict
+from dataclasses import dataclass
+from io import BytesIO, IOBase
+from typing import List, Optional, Sequence, Tuple, Union
 
 import numpy
 from colormath.color_objects import sRGBColor
-from PIL import Image
+from PIL import Image, ImageCms
 from scipy.cluster.vq import kmeans2
 
-# Throughout I am assuming that the input image is in the sRGB colour space which
-# of course may not always be true. TODO: support more colour spaces than sRGB.
+from .colours import ColourMatcher
+
+# Everything after convert_to_srgb works on 8-bit sRGB images. Images can come in all sorts of modes
+# (palette, greyscale, CMYK, L*a*b*, with or without alpha) and colour spaces (e.g. Adobe RGB, or CMYK print
+# profiles), so they're converted to plain RGB in sRGB, using the embedded ICC profile if there is one.
+# Images without a profile are assumed to be sRGB already (or naively converted to it, for CMYK). All
+# of this is done by Pillow on 8-bit data, before anything gets converted to floats.
+#
+# Applying a profile, splitting off alpha and compositing are per-pixel work, and most callers only
+# want a thumbnail, so it's done in two steps: open_image decodes the image and brings it to one of a
+# few 8-bit modes that can be resized, and convert_to_srgb then converts whatever size the caller
+# reduced it to.
+
+SRGB_PROFILE = ImageCms.ImageCmsProfile(ImageCms.createProfile("sRGB"))
+
+# for L*a*b* images without a profile of their own; Pillow's LAB mode is the D50 Lab that LittleCMS uses
+LAB_PROFILE = ImageCms.ImageCmsProfile(ImageCms.createProfile("LAB")).tobytes()
+
+# transparent areas are shown against white, as if printed on white paper
+DEFAULT_BACKGROUND = (255, 255, 255)
+
+
+# Building an ICC transform costs far more than applying it to a thumbnail, and most uploads share a
+# handful of profiles, so built transforms are kept in an LRU cache keyed by a hash of the profile.
+class IccTransformCache:
+    def __init__(self, maxsize: int = 32):
+        self.maxsize = maxsize
+        self._transforms: "OrderedDict[Tuple[bytes, str], ImageCms.ImageCmsTransform]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._transforms)
+
+    def get(self, icc_profile: bytes, mode: str) -> ImageCms.ImageCmsTransform:
+        key = (hashlib.sha256(icc_profile).digest(), mode)
+        with self._lock:
+            if key in self._transforms:
+                self._transforms.move_to_end(key)
+                return self._transforms[key]
+        # build outside the lock, as it's slow; at worst two threads build the same transform at once
+        transform = ImageCms.buildTransform(
+            ImageCms.ImageCmsProfile(BytesIO(icc_profile)),
+            SRGB_PROFILE,
+            mode,
+            "RGB",
+            # without this, LittleCMS caches the last pixel inside the transform, which isn't thread safe
+            flags=ImageCms.FLAGS["NOTCACHE"],
+        )
+        with self._lock:
+            self._transforms[key] = transform
+            while len(self._transforms) > self.maxsize:
+                self._transforms.popitem(last=False)
+        return transform
+
+
+ICC_TRANSFORMS = IccTransformCache()
+
+
+# the modes open_image leaves images in, which can all be resized (Pillow premultiplies alpha for that)
+SOURCE_MODES = ("L", "LA", "RGB", "RGBA", "CMYK", "LAB")
+
+
+def open_image(image_file: IOBase) -> Tuple[Image.Image, Optional[bytes]]:
+    # returns the image in one of SOURCE_MODES, still in its own colour space, and its ICC profile if any
+    pil_image = Image.open(image_file)
+    icc_profile = pil_image.info.get("icc_profile")
+    transparency = pil_image.info.get("transparency")
+
+    if pil_image.mode in ("P", "PA"):
+        # palette images are easiest to handle with an alpha channel for any transparent entries; their
+        # colours are still in the space described by the profile
+        pil_image = pil_image.convert("RGBA")
+    elif pil_image.mode.startswith("I"):
+        # 16-bit greyscale, which Pillow would clip rather than scale down to 8 bits; keep the top 8 bits,
+        # whatever the values are, so dark images stay dark
+        sixteen_bit = numpy.asarray(pil_image.convert("I"))
+        eight_bit = Image.fromarray((numpy.clip(sixteen_bit, 0, 0xFFFF) >> 8).astype(numpy.uint8), "L")
+        if isinstance(transparency, int):
+            # the transparent value has to be found before scaling, when it's still distinct
+            eight_bit.putalpha(Image.fromarray(numpy.where(sixteen_bit == transparency, 0, 255).astype(numpy.uint8)))
+        pil_image = eight_bit
+    elif pil_image.mode in ("RGBa", "La"):
+        # un-premultiply the alpha
+        pil_image = pil_image.convert(pil_image.mode.upper())
+    elif transparency is not None and pil_image.mode in ("1", "L", "RGB"):
+        # a single transparent colour; keep greyscale images greyscale, so a greyscale profile still fits
+        pil_image = pil_image.convert("RGBA" if pil_image.mode == "RGB" else "LA")
+    elif pil_image.mode == "1":
+        pil_image = pil_image.convert("L")
+    elif pil_image.mode not in SOURCE_MODES:
+        pil_image = pil_image.convert("RGB")
+    return pil_image, icc_profile
+
+
+def convert_to_srgb(
+    pil_image: Image.Image,
+    icc_profile: Optional[bytes] = None,
+    background: Tuple[int, int, int] = DEFAULT_BACKGROUND,
+    transforms: IccTransformCache = ICC_TRANSFORMS,
+) -> Image.Image:
+    # converts an image from open_image (usually after it has been resized) to RGB in sRGB
+    alpha = None
+    if pil_image.mode in ("RGBA", "LA"):
+        alpha = pil_image.getchannel("A")
+        pil_image = pil_image.convert("L" if pil_image.mode == "LA" else "RGB")
+
+    if pil_image.mode == "LAB" and not icc_profile:
+        # Pillow would reinterpret L*a*b* values as RGB, so these always need a transform
+        icc_profile = LAB_PROFILE
+    if icc_profile and pil_image.mode in ("RGB", "L", "CMYK", "LAB"):
+        try:
+            pil_image = ImageCms.applyTransform(pil_image, transforms.get(icc_profile, pil_image.mode))
+        except (ImageCms.PyCMSError, OSError):
+            # broken profile, or one that doesn't match the image's mode; carry on as if there was none
+            if pil_image.mode == "LAB":
+                pil_image = ImageCms.applyTransform(pil_image, transforms.get(LAB_PROFILE, "LAB"))
+    if pil_image.mode != "RGB":
+        pil_image = pil_image.convert("RGB")
+
+    if alpha is not None:
+        pil_image = Image.composite(pil_image, Image.new("RGB", pil_image.size, background), alpha)
+    return pil_image
 
 
 # ugly pattern we have to use for typing reasons until PEP 661 lands
@@ -24,18 +149,40 @@ class ImageColourSummariser(ABC):
     def image_file_to_numpy_array(
         image_file: IOBase, resize_to: Union[Optional[int], Sentinel] = SENTINEL
     ) -> numpy.ndarray:
-        pil_image = Image.open(image_file)
+        pil_image, icc_profile = open_image(image_file)
+        return ImageColourSummariser.pil_image_to_numpy_array(pil_image, resize_to=resize_to, icc_profile=icc_profile)
+
+    @staticmethod
+    def pil_image_to_numpy_array(
+        pil_image: Image.Image,
+        resize_to: Union[Optional[int], Sentinel] = SENTINEL,
+        reducing_gap: Optional[float] = None,
+        icc_profile: Optional[bytes] = None,
+        resample: Image.Resampling = Image.Resampling.LANCZOS,
+    ) -> numpy.ndarray:
+        # pil_image is as returned by open_image; it's only converted to sRGB once it has been resized
+        resized_image = ImageColourSummariser.resize_pil_image(
+            pil_image, resize_to=resize_to, reducing_gap=reducing_gap, resample=resample
+        )
+        numpy_image = numpy.asarray(convert_to_srgb(resized_image, icc_profile))
+        return numpy_image / 255.0
+
+    @staticmethod
+    def resize_pil_image(
+        pil_image: Image.Image,
+        resize_to: Union[Optional[int], Sentinel] = SENTINEL,
+        reducing_gap: Optional[float] = None,
+        resample: Image.Resampling = Image.Resampling.LANCZOS,
+    ) -> Image.Image:
         # k-means on the full-size image was much too slow (~10s per image on the examples)
         # resize the image to 200x200 (or other supplied size) using Lanczos, should hopefully
         # preserve enough detail to work with while being much faster
         if resize_to is SENTINEL:
             resize_to = 200
         if resize_to is not None:
-            resized_image = pil_image.resize((resize_to, resize_to), resample=Image.LANCZOS)
+            return pil_image.resize((resize_to, resize_to), resample=resample, reducing_gap=reducing_gap)
         else:
-            resized_image = pil_image
-        numpy_image = numpy.asarray(resized_image)
-        return numpy_image / 255.0
+            return pil_image
 
     @abstractmethod
     def summarise(
@@ -56,8 +203,163 @@ class KMeansImageColourSummariser(ImageColourSummariser):
         self, image_file: IOBase, resize_to: Union[Optional[int], Sentinel] = SENTINEL, clusters: int = 5
     ) -> sRGBColor:
         image = ImageColourSummariser.image_file_to_numpy_array(image_file, resize_to=resize_to)
+        most_popular_centroid, _ = KMeansImageColourSummariser.dominant_cluster(image, clusters=clusters)
+        return sRGBColor(*most_popular_centroid)
+
+    @staticmethod
+    def dominant_cluster(image: numpy.ndarray, clusters: int = 5) -> Tuple[numpy.ndarray, float]:
+        # returns the centroid of the most popular cluster, and the fraction of pixels in that cluster
         numpy_colours = image.reshape(-1, image.shape[2])
-        centroids, labels = kmeans2(numpy_colours, k=clusters, minit="points")
+        # can't have more clusters than pixels, which matters for tiny images at their original size
+        centroids, labels = kmeans2(numpy_colours, k=min(clusters, len(numpy_colours)), minit="points")
         counts = numpy.bincount(labels)
-        most_popular_centroid = centroids[numpy.argmax(counts)]
-        return sRGBColor(*most_popular_centroid)
+        most_popular = numpy.argmax(counts)
+        return centroids[most_popular], counts[most_popular] / len(labels)
+
+
+@dataclass
+class SummaryTier:
+    resize_to: Optional[int]
+    seconds: float
+    dominant_share: float
+    ambiguous: bool
+
+
+@dataclass
+class ProgressiveSummary:
+    colour: sRGBColor
+    tiers: List[SummaryTier]
+
+
+# Most of our images are product shots on a flat background, where k-means on a tiny thumbnail gives
+# the same answer as on the 200x200 version in a fraction of the time. So start small, and only move
+# up to the next resolution if the answer looks ambiguous: if the most popular cluster doesn't cover
+# much of the image, or (when we know which palette the colour will be matched against) if the
+# nearest palette colour is close to the max distance cutoff, or nearly as close as the second nearest.
+#
+# The thumbnails sample pixels rather than averaging them by default. Averaging makes textured or noisy
+# images look like a flat colour at 16x16, which k-means then splits into near-identical clusters,
+# so easy and hard images look equally (un)ambiguous. On the sample images, sampled 16x16 thumbnails
+# give a dominant share of 0.97 for the product shots, but 0.32-0.40 for hsvnoise.png at every size.
+class ProgressiveImageColourSummariser(ImageColourSummariser):
+    def __init__(
+        self,
+        # None means the full-size image; the default stops at 1000x1000 instead, as k-means on a
+        # print-sized image can take 10s or more and a gigabyte of floats, which would hog a summarise
+        # slot (and throw the limiter's service time estimate) for the sake of a rare ambiguous image
+        tiers: Sequence[Optional[int]] = (16, 64, 200, 1000),
+        clusters: int = 5,
+        min_dominant_share: float = 0.5,
+        min_distance_margin: float = 0.1,
+        reducing_gap: Optional[float] = 3.0,
+        resample: Image.Resampling = Image.Resampling.NEAREST,
+    ):
+        if len(tiers) == 0:
+            raise ValueError("need at least one tier")
+        self.tiers = tiers
+        self.clusters = clusters
+        self.min_dominant_share = min_dominant_share
+        self.min_distance_margin = min_distance_margin
+        # if resampling with e.g. Lanczos, that costs much more from a full-size image than the k-means
+        # on a thumbnail, so by default let Pillow do a cheap box reduction first (see Image.resize)
+        self.reducing_gap = reducing_gap
+        self.resample = resample
+
+    def is_ambiguous(
+        self,
+        colour: sRGBColor,
+        dominant_share: float,
+        matcher: Optional[ColourMatcher] = None,
+        max_distance: Optional[float] = None,
+    ) -> bool:
+        if dominant_share < self.min_dominant_share:
+            return True
+        return matcher is not None and self.is_near_boundary(colour, matcher, max_distance=max_distance)
+
+    def is_near_boundary(self, colour: sRGBColor, matcher: ColourMatcher, max_distance: Optional[float] = None) -> bool:
+        # whether a small change in the colour could change the answer
+        nearest = matcher.nearest_k(colour, k=2)
+        nearest_distance = nearest[0][1]
+        if max_distance is not None:
+            margin = self.min_distance_margin * max_distance
+            if abs(max_distance - nearest_distance) < margin:
+                return True
+        else:
+            # no cutoff to compare against, so fall back to a margin relative to the colours themselves
+            margin = self.min_distance_margin * nearest[-1][1]
+        if len(nearest) > 1 and nearest[1][1] - nearest_distance < margin:
+            return True
+        return False
+
+    def summarise_progressively(
+        self,
+        image_file: IOBase,
+        matcher: Optional[ColourMatcher] = None,
+        max_distance: Optional[float] = None,
+    ) -> ProgressiveSummary:
+        pil_image, icc_profile = open_image(image_file)
+        tiers: List[SummaryTier] = []
+        previous_match: Optional[Tuple[str, bool]] = None
+        for resize_to in self.tiers:
+            start = time.perf_counter()
+            # no point scaling small images up; do the last tier at their actual size instead
+            is_last = resize_to is None or resize_to >= max(pil_image.size) or len(tiers) == len(self.tiers) - 1
+            if resize_to is not None and resize_to >= max(pil_image.size):
+                resize_to = None
+            image = ImageColourSummariser.pil_image_to_numpy_array(
+                pil_image,
+                resize_to=resize_to,
+                reducing_gap=self.reducing_gap,
+                icc_profile=icc_profile,
+                resample=self.resample,
+            )
+            centroid, dominant_share = KMeansImageColourSummariser.dominant_cluster(image, clusters=self.clusters)
+            colour = sRGBColor(*centroid)
+            ambiguous = dominant_share < self.min_dominant_share
+            if matcher is not None:
+                name, distance = matcher.nearest(colour)
+                match = (name, max_distance is None or distance <= max_distance)
+                # some colours sit near a palette boundary at any resolution; once two tiers in a row
+                # agree on the answer, more pixels are unlikely to change it. That doesn't apply to a low
+                # dominant share, which is what more pixels are meant to resolve
+                if self.is_near_boundary(colour, matcher, max_distance=max_distance):
+                    ambiguous = ambiguous or match != previous_match
+                previous_match = match
+            tiers.append(SummaryTier(resize_to, time.perf_counter() - start, dominant_share, ambiguous))
+            if is_last or not ambiguous:
+                break
+        return ProgressiveSummary(colour, tiers)
+
+    def summarise(self, image_file: IOBase, resize_to: Union[Optional[int], Sentinel] = SENTINEL) -> sRGBColor:
+        if resize_to is not SENTINEL:
+            # a fixed size was asked for, so there's nothing to be progressive about
+            image = ImageColourSummariser.image_file_to_numpy_array(image_file, resize_to=resize_to)
+            centroid, _ = KMeansImageColourSummariser.dominant_cluster(image, clusters=self.clusters)
+            return sRGBColor(*centroid)
+        return self.summarise_progressively(image_file).colour
+
+
+# Both of the above convert the whole image to float64 before doing anything with it. Pillow's own
+# quantizers work directly on the 8-bit image in C, so they're much cheaper: reduce the image to a
+# few colours, then pick the one used by the most pixels, much as with k-means.
+class QuantizeImageColourSummariser(ImageColourSummariser):
+    def __init__(
+        self, method: Image.Quantize = Image.Quantize.MEDIANCUT, colours: int = 5, reducing_gap: Optional[float] = 3.0
+    ):
+        self.method = method
+        self.colours = colours
+        self.reducing_gap = reducing_gap
+
+    def summarise(self, image_file: IOBase, resize_to: Union[Optional[int], Sentinel] = SENTINEL) -> sRGBColor:
+        source_image, icc_profile = open_image(image_file)
+        pil_image = convert_to_srgb(
+            ImageColourSummariser.resize_pil_image(source_image, resize_to=resize_to, reducing_gap=self.reducing_gap),
+            icc_profile,
+        )
+        quantized_image = pil_image.quantize(colors=self.colours, method=self.method)
+        # list of (pixel count, palette index); can't be more than 256 of them in a palette image
+        _, most_popular_index = max(quantized_image.getcolors(maxcolors=256))
+        palette = quantized_image.getpalette()
+        start = most_popular_index * 3
+        red, green, blue = palette[start : start + 3]
+        return sRGBColor(red, green, blue, is_upscaled=True)
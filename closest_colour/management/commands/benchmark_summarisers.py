@@ -0,0 +1,102 @@
+import time
+from io import BytesIO
+from pathlib import Path
+from typing import Any, Dict, List
+
+import numpy
+from colormath.color_objects import sRGBColor
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+from PIL import Image
+
+from closest_colour.images import ImageColourSummariser
+
+
+def srgb_distance(a: sRGBColor, b: sRGBColor) -> float:
+    return float(sum((x - y) ** 2 for x, y in zip(a.get_value_tuple(), b.get_value_tuple())) ** 0.5)
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the speed (CPU time per image, with and without decoding) and accuracy (distance from the "
+        "reference summariser's colour, and whether the same palette colour is matched) of the configured image "
+        "summarisers"
+    )
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "images", nargs="*", type=Path, help="image files to summarise (default: everything in images/)"
+        )
+        parser.add_argument(
+            "--summariser",
+            action="append",
+            dest="summarisers",
+            help="summariser to benchmark, may be given more than once (default: all of IMAGE_SUMMARISERS)",
+        )
+        parser.add_argument("--reference", default="kmeans", help="summariser to measure accuracy against")
+        parser.add_argument("--colour-space", default=settings.DEFAULT_COLOUR_SPACE)
+        parser.add_argument("--repeat", type=int, default=3, help="number of times to summarise each image")
+        parser.add_argument(
+            "--seed", type=int, default=0, help="random seed for k-means, so the same summariser gives the same answer"
+        )
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        images: List[Path] = options["images"] or sorted((settings.BASE_DIR / "images").glob("*.png"))
+        names: List[str] = options["summarisers"] or list(settings.IMAGE_SUMMARISERS)
+        reference: str = options["reference"]
+        for name in names + [reference]:
+            if name not in settings.IMAGE_SUMMARISERS:
+                raise CommandError(f"Unknown image summariser '{name}'")
+        if options["colour_space"] not in settings.COLOUR_MATCHERS:
+            raise CommandError(f"Unknown colour space '{options['colour_space']}'")
+        matcher = settings.COLOUR_MATCHERS[options["colour_space"]]
+        repeat: int = options["repeat"]
+        seed: int = options["seed"]
+
+        totals: Dict[str, float] = {name: 0.0 for name in names}
+        summarise_totals: Dict[str, float] = {name: 0.0 for name in names}
+        agreements: Dict[str, int] = {name: 0 for name in names}
+        self.stdout.write(
+            f"{'image':<28} {'summariser':<14} {'cpu ms':>8} {'excl decode':>11} {'distance':>9} {'colour':<20} agrees"
+        )
+        for path in images:
+            data = path.read_bytes()
+            # decoding dominates for large images and is the same for every summariser, so report it separately
+            start = time.process_time()
+            Image.open(BytesIO(data)).load()
+            decode_seconds = time.process_time() - start
+            self.stdout.write(f"{path.name:<28} {'(decode)':<14} {decode_seconds * 1000:>8.1f}")
+
+            # k-means starts from randomly chosen points (with NumPy's global RNG), so without a fixed seed
+            # the reference itself would vary between runs, and disagree with its own summariser
+            numpy.random.seed(seed)
+            reference_colour = settings.IMAGE_SUMMARISERS[reference].summarise(BytesIO(data))
+            reference_name, _ = matcher.nearest(reference_colour)
+            for name in names:
+                summariser: ImageColourSummariser = settings.IMAGE_SUMMARISERS[name]
+                numpy.random.seed(seed)
+                start = time.process_time()
+                for _ in range(repeat):
+                    colour = summariser.summarise(BytesIO(data))
+                cpu_seconds = (time.process_time() - start) / repeat
+                # every summariser decodes the image itself, which can hide the differences between them
+                summarise_seconds = max(0.0, cpu_seconds - decode_seconds)
+                colour_name, _ = matcher.nearest(colour)
+                agrees = colour_name == reference_name
+                totals[name] += cpu_seconds
+                summarise_totals[name] += summarise_seconds
+                agreements[name] += agrees
+                self.stdout.write(
+                    f"{path.name:<28} {name:<14} {cpu_seconds * 1000:>8.1f} {summarise_seconds * 1000:>11.1f} "
+                    f"{srgb_distance(colour, reference_colour):>9.4f} {colour_name:<20} {'yes' if agrees else 'NO'}"
+                )
+
+        self.stdout.write("")
+        self.stdout.write(
+            f"{'summariser':<14} {'mean cpu ms':>12} {'excl decode':>12} {'agrees with ' + reference:>20}"
+        )
+        for name in names:
+            self.stdout.write(
+                f"{name:<14} {totals[name] / len(images) * 1000:>12.1f} "
+                f"{summarise_totals[name] / len(images) * 1000:>12.1f} {agreements[name]:>12}/{len(images)}"
+            )
@@ -0,0 +1,413 @@
+import json
+import os
+import random
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+from PIL import Image
+from requests.adapters import HTTPAdapter
+
+# Open-loop load testing of the match endpoint. A local HTTP server stands in for the sites that
+# images are normally fetched from, serving the sample images and synthetic large images with
+# configurable latency and bandwidth. Requests are sent at scheduled times whether or not earlier
+# ones have finished, as real clients would, and latency is measured from the scheduled time, so a
+# server that falls behind can't hide it by slowing down the load generator.
+#
+# Point it at a running server, e.g. one started with runserver, gunicorn (WSGI) or uvicorn (ASGI),
+# and label the run, to compare deployment configurations.
+
+CHUNK_SIZE = 16 * 1024
+
+# the most we expect to be asked to summarise; much bigger noise images would just exhaust memory
+MAX_SYNTHETIC_SIDE = 10000
+
+
+def synthetic_size(path: str) -> Optional[Tuple[int, int]]:
+    # e.g. "synthetic/30x20.png" gives (30, 20); None if it isn't a synthetic image we're willing to make
+    if not (path.startswith("synthetic/") and path.endswith(".png")):
+        return None
+    try:
+        width, height = (int(n) for n in path[len("synthetic/") : -len(".png")].split("x"))
+    except ValueError:
+        return None
+    if not (1 <= width <= MAX_SYNTHETIC_SIDE and 1 <= height <= MAX_SYNTHETIC_SIDE):
+        return None
+    return width, height
+
+
+class ImageRequestHandler(BaseHTTPRequestHandler):
+    server: "ImageServer"
+
+    def do_GET(self) -> None:
+        content = self.server.image_content(urllib.parse.urlparse(self.path).path)
+        time.sleep(self.server.latency)
+        if content is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        for start in range(0, len(content), CHUNK_SIZE):
+            chunk = content[start : start + CHUNK_SIZE]
+            self.wfile.write(chunk)
+            if self.server.bandwidth is not None:
+                time.sleep(len(chunk) / self.server.bandwidth)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+class ImageServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    # serves /images/<name> from the images directory, and /synthetic/<width>x<height>.png as random noise
+    def __init__(self, images_dir: Path, latency: float = 0.0, bandwidth: Optional[float] = None, port: int = 0):
+        super().__init__(("127.0.0.1", port), ImageRequestHandler)
+        self.images_dir = images_dir
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self._synthetic: Dict[Tuple[int, int], bytes] = {}
+        self._synthetic_lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host!s}:{port}"
+
+    def image_content(self, path: str) -> Optional[bytes]:
+        if path.startswith("/images/"):
+            image_path = self.images_dir / path[len("/images/") :]
+            # don't let ../ escape the images directory
+            if image_path.resolve().parent != self.images_dir.resolve() or not image_path.is_file():
+                return None
+            return image_path.read_bytes()
+        size = synthetic_size(path[1:])
+        if size is not None:
+            return self.synthetic_image(*size)
+        return None
+
+    def synthetic_image(self, width: int, height: int) -> bytes:
+        with self._synthetic_lock:
+            if (width, height) not in self._synthetic:
+                # noise is the worst case both for PNG compression and for the summarisers
+                pixels = numpy.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=numpy.uint8)
+                image_file = BytesIO()
+                Image.fromarray(pixels).save(image_file, format="PNG", compress_level=1)
+                self._synthetic[(width, height)] = image_file.getvalue()
+            return self._synthetic[(width, height)]
+
+
+@dataclass
+class PlannedRequest:
+    offset: float
+    image_url: str
+    params: Dict[str, str] = field(default_factory=dict)
+
+
+@dataclass
+class Result:
+    offset: float
+    latency: float
+    status: Optional[int]
+
+
+def poisson_offsets(rate: float, start: float, end: float, rng: random.Random) -> Iterator[float]:
+    if rate <= 0.0:
+        # e.g. bursts with no background traffic
+        return
+    offset = start + rng.expovariate(rate)
+    while offset < end:
+        yield offset
+        offset += rng.expovariate(rate)
+
+
+def steady_offsets(rate: float, duration: float, rng: random.Random) -> List[float]:
+    return list(poisson_offsets(rate, 0.0, duration, rng))
+
+
+def bursty_offsets(
+    rate: float, burst_rate: float, burst_length: float, burst_interval: float, duration: float, rng: random.Random
+) -> List[float]:
+    # the background rate all the time, plus an extra burst_rate for burst_length at the start of each interval
+    offsets = steady_offsets(rate, duration, rng)
+    for burst_start in numpy.arange(0.0, duration, burst_interval):
+        offsets += poisson_offsets(burst_rate, burst_start, min(burst_start + burst_length, duration), rng)
+    return sorted(offsets)
+
+
+def replay_plan(lines: List[str], image_base_url: str) -> List[PlannedRequest]:
+    # each line is e.g. {"offset": 1.5, "image": "test-sample-teal.png", "params": {"summariser": "mean"}},
+    # where "image" can also be "synthetic/4000x4000.png", or "url" can be given instead of "image"
+    plan = []
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            entry = json.loads(line)
+            offset = float(entry["offset"])
+            if "url" in entry:
+                image_url = entry["url"]
+            else:
+                image = entry["image"]
+                image_url = f"{image_base_url}/{image if image.startswith('synthetic/') else 'images/' + image}"
+            params = {str(k): str(v) for k, v in entry.get("params", {}).items()}
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            raise CommandError(f"Invalid replay log entry on line {line_number}: {e}")
+        plan.append(PlannedRequest(offset, image_url, params))
+    return sorted(plan, key=lambda planned: planned.offset)
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    return float(numpy.percentile(values, q)) if values else None
+
+
+class ProcessMonitor:
+    # samples CPU time and RSS of server worker processes from /proc (so Linux only)
+    def __init__(self, pids: List[int], interval: float = 0.2):
+        self.pids = pids
+        self.interval = interval
+        self.clock_ticks = os.sysconf("SC_CLK_TCK")
+        self.start_cpu: Dict[int, float] = {}
+        self.peak_rss: Dict[int, int] = {pid: 0 for pid in pids}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def cpu_seconds(self, pid: int) -> float:
+        # the command name can contain spaces, so split after its closing bracket
+        fields = Path(f"/proc/{pid}/stat").read_text().rsplit(")", 1)[1].split()
+        # utime and stime are fields 14 and 15 of the whole line
+        return (int(fields[11]) + int(fields[12])) / self.clock_ticks
+
+    @staticmethod
+    def rss_bytes(pid: int) -> int:
+        for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+        return 0
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval):
+            for pid in self.pids:
+                try:
+                    self.peak_rss[pid] = max(self.peak_rss[pid], self.rss_bytes(pid))
+                except OSError:
+                    pass  # worker may have been restarted
+
+    def start(self) -> None:
+        try:
+            self.start_cpu = {pid: self.cpu_seconds(pid) for pid in self.pids}
+        except OSError as e:
+            raise CommandError(f"Can't monitor worker processes: {e}")
+        self._thread.start()
+
+    def stop(self) -> Dict[str, Dict[str, Optional[float]]]:
+        self._stop.set()
+        self._thread.join()
+        report: Dict[str, Dict[str, Optional[float]]] = {}
+        for pid in self.pids:
+            try:
+                cpu: Optional[float] = self.cpu_seconds(pid) - self.start_cpu[pid]
+                self.peak_rss[pid] = max(self.peak_rss[pid], self.rss_bytes(pid))
+            except OSError:
+                cpu = None
+            report[str(pid)] = {"cpu_seconds": cpu, "peak_rss_mib": self.peak_rss[pid] / 1024 / 1024}
+        return report
+
+
+def run_plan(
+    plan: List[PlannedRequest], target: str, auth: Optional[Tuple[str, str]], timeout: float, max_in_flight: int
+) -> Tuple[List[Result], float]:
+    results: List[Result] = []
+    results_lock = threading.Lock()
+    session = requests.Session()
+    session.auth = auth
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    def send(planned: PlannedRequest, scheduled: float) -> None:
+        try:
+            response = session.get(
+                f"{target}/colours/match", params={"url": planned.image_url, **planned.params}, timeout=timeout
+            )
+            response_status: Optional[int] = response.status_code
+        except requests.RequestException:
+            response_status = None
+        # measured from when the request should have been sent, not when a thread got round to it
+        latency = time.monotonic() - scheduled
+        with results_lock:
+            results.append(Result(planned.offset, latency, response_status))
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        for planned in plan:
+            scheduled = start + planned.offset
+            delay = scheduled - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(send, planned, scheduled)
+    return results, time.monotonic() - start
+
+
+def summarise_results(results: List[Result], elapsed: float) -> Dict[str, Any]:
+    statuses: Dict[str, int] = {}
+    for result in results:
+        key = "connection error" if result.status is None else str(result.status)
+        statuses[key] = statuses.get(key, 0) + 1
+    # 404 means no palette colour was close enough, which is a perfectly good answer
+    ok_latencies = [result.latency for result in results if result.status in (200, 404)]
+    return {
+        "requests": len(results),
+        "elapsed_seconds": elapsed,
+        "throughput_per_second": len(ok_latencies) / elapsed if elapsed > 0 else None,
+        "error_rate": (len(results) - len(ok_latencies)) / len(results) if results else None,
+        "statuses": statuses,
+        "latency_seconds": {
+            "p50": percentile(ok_latencies, 50),
+            "p90": percentile(ok_latencies, 90),
+            "p99": percentile(ok_latencies, 99),
+            "max": max(ok_latencies) if ok_latencies else None,
+        },
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        "Load test a running server's /colours/match endpoint with open-loop steady, bursty or replayed "
+        "traffic, fetching images from a local stand-in image server, and report throughput, latency "
+        "percentiles, error rates and server worker CPU/RSS"
+    )
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--target", default="http://localhost:8000", help="base URL of the server under test")
+        parser.add_argument("--user", help="username:password to authenticate with")
+        parser.add_argument("--pattern", choices=("steady", "bursty", "replay"), default="steady")
+        parser.add_argument("--rate", type=float, default=1.0, help="mean requests per second")
+        parser.add_argument("--duration", type=float, default=60.0, help="seconds of traffic to send")
+        parser.add_argument("--burst-rate", type=float, default=10.0, help="extra requests per second in bursts")
+        parser.add_argument("--burst-length", type=float, default=5.0, help="seconds each burst lasts")
+        parser.add_argument("--burst-interval", type=float, default=30.0, help="seconds between burst starts")
+        parser.add_argument("--replay", type=Path, help="JSONL request log to replay (with --pattern replay)")
+        parser.add_argument(
+            "--image",
+            action="append",
+            dest="images",
+            help="sample image name, or synthetic/<width>x<height>.png, to request (default: all sample images)",
+        )
+        parser.add_argument(
+            "--param", action="append", default=[], help="extra query parameter for every request, as name=value"
+        )
+        parser.add_argument("--latency", type=float, default=0.0, help="seconds the image server waits to respond")
+        parser.add_argument("--bandwidth", type=float, help="image server bytes per second for each response")
+        parser.add_argument("--image-port", type=int, default=0, help="image server port (default: any free port)")
+        parser.add_argument("--timeout", type=float, default=30.0, help="client timeout per request in seconds")
+        parser.add_argument("--max-in-flight", type=int, default=256, help="most requests to have open at once")
+        parser.add_argument(
+            "--worker-pid", type=int, action="append", default=[], help="server worker process to monitor"
+        )
+        parser.add_argument("--seed", type=int, help="random seed for arrival times")
+        parser.add_argument("--label", default="", help="name for this run, e.g. the deployment configuration")
+        parser.add_argument("--output", type=Path, help="also write the report as JSON to this file")
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        auth = None
+        if options["user"] is not None:
+            username, _, password = options["user"].partition(":")
+            auth = (username, password)
+        try:
+            extra_params = dict(param.split("=", 1) for param in options["param"])
+        except ValueError:
+            raise CommandError("--param must be given as name=value")
+
+        server = ImageServer(
+            settings.BASE_DIR / "images",
+            latency=options["latency"],
+            bandwidth=options["bandwidth"],
+            port=options["image_port"],
+        )
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            plan = self.make_plan(options, server, extra_params)
+            monitor = ProcessMonitor(options["worker_pid"])
+            monitor.start()
+            results, elapsed = run_plan(
+                plan, options["target"].rstrip("/"), auth, options["timeout"], options["max_in_flight"]
+            )
+            workers = monitor.stop()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        report = {
+            "label": options["label"],
+            "pattern": options["pattern"],
+            **summarise_results(results, elapsed),
+            "workers": workers,
+        }
+        self.stdout.write(json.dumps(report, indent=2))
+        if options["output"] is not None:
+            options["output"].write_text(json.dumps(report, indent=2))
+
+    @staticmethod
+    def make_plan(options: Dict[str, Any], server: ImageServer, extra_params: Dict[str, str]) -> List[PlannedRequest]:
+        if options["pattern"] == "replay":
+            if options["replay"] is None:
+                raise CommandError("--pattern replay needs a --replay log file")
+            plan = replay_plan(options["replay"].read_text().splitlines(), server.base_url)
+            for planned in plan:
+                planned.params = {**extra_params, **planned.params}
+        else:
+            plan = Command.make_generated_plan(options, server.base_url, extra_params)
+
+        # making a big noise image takes seconds, which shouldn't be charged to the first requests for it
+        synthetic_prefix = f"{server.base_url}/synthetic/"
+        for image_url in sorted({planned.image_url for planned in plan}):
+            if image_url.startswith(synthetic_prefix):
+                size = synthetic_size(image_url[len(server.base_url) + 1 :])
+                if size is None:
+                    raise CommandError(
+                        f"Invalid synthetic image {image_url}, should be <width>x<height>.png with sides of 1 to "
+                        f"{MAX_SYNTHETIC_SIDE} pixels"
+                    )
+                server.synthetic_image(*size)
+        return plan
+
+    @staticmethod
+    def make_generated_plan(
+        options: Dict[str, Any], image_base_url: str, extra_params: Dict[str, str]
+    ) -> List[PlannedRequest]:
+        for option in ("rate", "duration", "burst_rate", "burst_length"):
+            if options[option] < 0.0:
+                raise CommandError(f"--{option.replace('_', '-')} can't be negative")
+        if options["pattern"] == "bursty" and options["burst_interval"] <= 0.0:
+            raise CommandError("--burst-interval must be more than 0")
+
+        rng = random.Random(options["seed"])
+        if options["pattern"] == "steady":
+            offsets = steady_offsets(options["rate"], options["duration"], rng)
+        else:
+            offsets = bursty_offsets(
+                options["rate"],
+                options["burst_rate"],
+                options["burst_length"],
+                options["burst_interval"],
+                options["duration"],
+                rng,
+            )
+        images = options["images"] or sorted(path.name for path in (settings.BASE_DIR / "images").glob("*.png"))
+        image_urls = [
+            f"{image_base_url}/{image if image.startswith('synthetic/') else 'images/' + image}" for image in images
+        ]
+        return [PlannedRequest(offset, rng.choice(image_urls), dict(extra_params)) for offset in offsets]
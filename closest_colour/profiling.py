@@ -0,0 +1,129 @@
+import cProfile
+import io
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+import tracemalloc
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, List, Mapping, Optional
+
+# Opt-in profiling of real requests, for when one kind of image (huge PNGs, noise) is slow in
+# production and we can't tell why from a laptop. A request is profiled if it's picked at random
+# according to the sample rate, or if a staff user sends the profiling header. Everything else just
+# pays for a call to random() and a header lookup.
+#
+# Each profiled request writes a .pstats file, which can be loaded with pstats, snakeviz, gprof2dot,
+# etc., and a .txt summary of the hottest functions. If memory tracing is on (for every profiled
+# request, or for requests with the header set to "memory"), the summary also has the peak traced
+# memory and the biggest allocations still held at the end of the request. Only the newest
+# max_dumps profiles are kept.
+
+logger = logging.getLogger(__name__)
+
+TRACEMALLOC_FRAMES = 25
+
+MEMORY_HEADER_VALUE = "memory"
+
+
+class RequestProfiler:
+    def __init__(
+        self,
+        directory: Path,
+        sample_rate: float = 0.0,
+        header: Optional[str] = "X-Profile",
+        max_dumps: int = 100,
+        trace_memory: bool = False,
+    ):
+        self.directory = Path(directory)
+        self.sample_rate = sample_rate
+        self.header = header
+        self.max_dumps = max_dumps
+        self.trace_memory = trace_memory
+        # tracemalloc is global to the process, so only one request can usefully trace at once
+        self._tracemalloc_lock = threading.Lock()
+
+    def should_profile(self, headers: Mapping[str, str], is_staff: bool) -> bool:
+        if self.sample_rate > 0.0 and random.random() < self.sample_rate:
+            return True
+        # only trust the header from staff, otherwise anyone could make us do extra work
+        return self.header is not None and self.header in headers and is_staff
+
+    def should_trace_memory(self, headers: Mapping[str, str]) -> bool:
+        if self.trace_memory:
+            return True
+        return self.header is not None and headers.get(self.header, "").lower() == MEMORY_HEADER_VALUE
+
+    @contextmanager
+    def profile(self, name: str, trace_memory: bool = False) -> Iterator[None]:
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiler is already running in this thread (e.g. someone's debugger); leave it be
+            yield
+            return
+
+        tracing = trace_memory and not tracemalloc.is_tracing() and self._tracemalloc_lock.acquire(blocking=False)
+        if tracing:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            profile.disable()
+            memory_lines: List[str] = []
+            if tracing:
+                try:
+                    memory_lines = self._memory_summary()
+                finally:
+                    tracemalloc.stop()
+                    self._tracemalloc_lock.release()
+            try:
+                self._write(name, elapsed, profile, memory_lines)
+            except OSError:
+                # profiling must never change the response, e.g. because the disk is full
+                logger.exception("Could not write profile of %s to %s", name, self.directory)
+
+    @staticmethod
+    def _memory_summary() -> List[str]:
+        # for the match endpoint, the peak is normally the float64 copy of the image made in
+        # image_file_to_numpy_array; anything still held at the end may be a leak (or a cache)
+        _, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        lines = [f"peak traced memory: {peak / 1024 / 1024:.1f} MiB", "", "largest allocations still held:"]
+        for stat in snapshot.statistics("traceback")[:10]:
+            lines.append(f"{stat.size / 1024:.1f} KiB in {stat.count} blocks")
+            lines += ["    " + line for line in stat.traceback.format(limit=5)]
+        return lines
+
+    def _write(self, name: str, elapsed: float, profile: cProfile.Profile, memory_lines: List[str]) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # down to the nanosecond, in UTC so the clocks never go back, so that sorting names sorts by age even
+        # for profiles written in the same second
+        now_ns = time.time_ns()
+        timestamp = time.strftime("%Y%m%dT%H%M%S", time.gmtime(now_ns // 1_000_000_000))
+        stem = f"{timestamp}.{now_ns % 1_000_000_000:09d}Z-{name}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        profile.dump_stats(self.directory / f"{stem}.pstats")
+
+        stats_text = io.StringIO()
+        pstats.Stats(profile, stream=stats_text).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(40)
+        summary = [f"{name} took {elapsed:.3f}s", ""] + memory_lines + ["", stats_text.getvalue()]
+        (self.directory / f"{stem}.txt").write_text("\n".join(summary))
+        self._rotate()
+
+    def _rotate(self) -> None:
+        # file names start with the time, so sorting them sorts by age
+        dumps = sorted(self.directory.glob("*.pstats"))
+        for old_dump in dumps[: max(0, len(dumps) - self.max_dumps)]:
+            for path in (old_dump, old_dump.with_suffix(".txt")):
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    # another worker process got there first
+                    pass
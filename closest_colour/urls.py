@@ -1,7 +1,9 @@
 from django.urls import path
 
-from .views import MatchColour
+from .views import AdmissionStatus, MatchColour, PaletteCoverage
 
 urlpatterns = [
     path("match", MatchColour.as_view()),
+    path("coverage", PaletteCoverage.as_view()),
+    path("admission", AdmissionStatus.as_view()),
 ]
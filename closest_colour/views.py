@@ -1,44 +1,135 @@
+import functools
 import urllib.parse
 from io import BytesIO
+from typing import Any, Callable, List, Optional, Tuple, TypeVar, Union
 
+import numpy
 import PIL
 import requests
 from django.conf import settings
+from django.core.cache import caches
 from rest_framework import permissions, status
 from rest_framework.request import Request
 from rest_framework.response import Response
+from rest_framework.throttling import UserRateThrottle
 from rest_framework.views import APIView
 
+from .admission import Overloaded
+from .coverage import palette_coverage
+from .images import (
+    ProgressiveImageColourSummariser,
+    ProgressiveSummary,
+    open_image,
+)
+from .profiling import RequestProfiler
+
+
+class MatchColourThrottle(UserRateThrottle):
+    # per-user (or per-IP for anonymous requests) rate limit, configured through
+    # REST_FRAMEWORK["DEFAULT_THROTTLE_RATES"]["match_colour"] in settings
+    scope = "match_colour"
+    # shared by all worker processes; see CACHES in settings
+    cache = caches["throttle"]
+
+
+class PaletteCoverageThrottle(UserRateThrottle):
+    # matching every pixel costs much more than matching one colour, so has its own rate limit
+    scope = "palette_coverage"
+    cache = caches["throttle"]
+
+
+ViewMethod = TypeVar("ViewMethod", bound=Callable[..., Response])
+
+
+def profiled(view_method: ViewMethod) -> ViewMethod:
+    # profiles the decorated handler for requests picked by settings.REQUEST_PROFILER, if there is one
+    @functools.wraps(view_method)
+    def wrapper(self: APIView, request: Request, *args: Any, **kwargs: Any) -> Response:
+        profiler: Optional[RequestProfiler] = getattr(settings, "REQUEST_PROFILER", None)
+        if profiler is None or not profiler.should_profile(request.headers, request.user.is_staff):
+            return view_method(self, request, *args, **kwargs)
+        with profiler.profile(type(self).__name__, trace_memory=profiler.should_trace_memory(request.headers)):
+            return view_method(self, request, *args, **kwargs)
+
+    return wrapper  # type: ignore[return-value]
+
+
+def server_timing_header(summary: ProgressiveSummary) -> str:
+    # e.g. "tier16;dur=3.1, tier64;dur=4.7" - durations are in milliseconds, as the spec requires
+    return ", ".join(
+        f"tier{'full' if tier.resize_to is None else tier.resize_to};dur={tier.seconds * 1000:.1f}"
+        for tier in summary.tiers
+    )
+
+
+def overloaded_response(e: Overloaded) -> Response:
+    return Response(
+        {"errors": ["Server is too busy to handle this request, please retry later"]},
+        status=status.HTTP_503_SERVICE_UNAVAILABLE,
+        headers={"Retry-After": e.retry_after_header},
+    )
+
+
+def parse_url(request: Request, errors: List[str]) -> str:
+    url = request.query_params.get("url", None)
+    if url is None:
+        errors.append("Please specify a 'url' query parameter")
+        return ""
+    parsed_url = urllib.parse.urlparse(url)
+    if parsed_url.scheme.lower() not in ("http", "https"):
+        # prevent file:// attacks etc
+        errors.append("Only http or https URLs are allowed")
+    return url
+
+
+def parse_colour_space(request: Request, errors: List[str]) -> Tuple[str, float]:
+    space = request.query_params.get("colour_space", settings.DEFAULT_COLOUR_SPACE).lower()
+    if space not in settings.COLOUR_MATCHERS or space not in settings.DEFAULT_MAX_DISTANCES:
+        errors.append("Invalid colour space")
+        return space, -1.0
+    max_distance_str = request.query_params.get("max_distance", None)
+    if max_distance_str is None:
+        return space, settings.DEFAULT_MAX_DISTANCES[space]
+    try:
+        return space, float(max_distance_str)
+    except ValueError:
+        errors.append("Invalid max distance")
+        return space, -1.0
+
+
+def fetch_image(url: str) -> Union[BytesIO, Response]:
+    # returns the fetched image, or an error response
+    # This is potentially a big security hole, at the very least for reflected DDOSes.
+    # Make sure the calling view's permissions are set to at least IsAuthenticated.
+    try:
+        with settings.FETCH_LIMITER.slot():
+            r = requests.get(url, timeout=settings.FETCH_TIMEOUT)
+    except Overloaded as e:
+        return overloaded_response(e)
+    except requests.RequestException:
+        return Response(
+            {"errors": ["Could not fetch the URL given, could not connect"]},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+
+    if not r.ok:
+        return Response(
+            {"errors": [f"Could not fetch the URL given, status code was {r.status_code}"]},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+    return BytesIO(r.content)
+
 
 class MatchColour(APIView):
     permission_classes = [permissions.IsAuthenticated]
+    throttle_classes = [MatchColourThrottle]
 
+    @profiled
     def get(self, request: Request) -> Response:
-        errors = []
-
-        url = request.query_params.get("url", None)
-        if url is not None:
-            parsed_url = urllib.parse.urlparse(url)
-            if parsed_url.scheme.lower() not in ("http", "https"):
-                # prevent file:// attacks etc
-                errors.append("Only http or https URLs are allowed")
-        else:
-            url = ""  # for "might be referenced before assignment"
-            errors.append("Please specify a 'url' query parameter")
-
-        space = request.query_params.get("colour_space", settings.DEFAULT_COLOUR_SPACE).lower()
-        if space not in settings.COLOUR_MATCHERS or space not in settings.DEFAULT_MAX_DISTANCES:
-            errors.append("Invalid colour space")
-        else:
-            max_distance_str = request.query_params.get("max_distance", None)
-            if max_distance_str is None:
-                max_distance = settings.DEFAULT_MAX_DISTANCES[space]
-            else:
-                try:
-                    max_distance = float(max_distance_str)
-                except ValueError:
-                    max_distance = -1.0  # for "might be referenced before assignment"
-                    errors.append("Invalid max distance")
+        errors: List[str] = []
+
+        url = parse_url(request, errors)
+        space, max_distance = parse_colour_space(request, errors)
 
         summariser = request.query_params.get("summariser", settings.DEFAULT_IMAGE_SUMMARISER).lower()
         if summariser not in settings.IMAGE_SUMMARISERS:
@@ -47,33 +138,139 @@ class MatchColour(APIView):
         if errors != []:
             return Response({"errors": errors}, status=status.HTTP_400_BAD_REQUEST)
 
-        # This is potentially a big security hole, at the very least for reflected DDOSes.
-        # Make sure this view's permissions are set to at least IsAuthenticated.
         try:
-            r = requests.get(url)
-        except requests.RequestException:
-            return Response(
-                {"errors": ["Could not fetch the URL given, could not connect"]},
-                status=status.HTTP_400_BAD_REQUEST,
-            )
+            # no point fetching the image if we'd only turn the request away once it arrives; the slot
+            # below still sheds requests if things got busier during the fetch
+            settings.SUMMARISE_LIMITER.check()
+        except Overloaded as e:
+            return overloaded_response(e)
 
-        if not r.ok:
-            return Response(
-                {"errors": [f"Could not fetch the URL given, status code was {r.status_code}"]},
-                status=status.HTTP_400_BAD_REQUEST,
-            )
-        image_file = BytesIO(r.content)
+        image_file = fetch_image(url)
+        if isinstance(image_file, Response):
+            return image_file
 
+        summary = None
         try:
-            image_colour = settings.IMAGE_SUMMARISERS[summariser].summarise(image_file)
+            with settings.SUMMARISE_LIMITER.slot():
+                image_summariser = settings.IMAGE_SUMMARISERS[summariser]
+                if isinstance(image_summariser, ProgressiveImageColourSummariser):
+                    # this one can stop early if it knows what the colour will be matched against
+                    summary = image_summariser.summarise_progressively(
+                        image_file, matcher=settings.COLOUR_MATCHERS[space], max_distance=max_distance
+                    )
+                    image_colour = summary.colour
+                else:
+                    image_colour = image_summariser.summarise(image_file)
+        except Overloaded as e:
+            return overloaded_response(e)
         except PIL.UnidentifiedImageError:
             return Response({"errors": ["Could not parse image"]}, status=status.HTTP_400_BAD_REQUEST)
 
         nearest_colour, distance = settings.COLOUR_MATCHERS[space].nearest(image_colour)
 
+        headers = {"Server-Timing": server_timing_header(summary)} if summary is not None else None
+
         if distance > max_distance:
             return Response(
-                {"errors": [f"No colour found within {max_distance} units"]}, status=status.HTTP_404_NOT_FOUND
+                {"errors": [f"No colour found within {max_distance} units"]},
+                status=status.HTTP_404_NOT_FOUND,
+                headers=headers,
             )
 
-        return Response({"colour": nearest_colour, "distance": distance})
+        return Response({"colour": nearest_colour, "distance": distance}, headers=headers)
+
+
+class AdmissionStatus(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request: Request) -> Response:
+        return Response(
+            {
+                "fetch": settings.FETCH_LIMITER.depth(),
+                "summarise": settings.SUMMARISE_LIMITER.depth(),
+                "coverage": settings.COVERAGE_LIMITER.depth(),
+            }
+        )
+
+
+class PaletteCoverage(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+    throttle_classes = [PaletteCoverageThrottle]
+
+    @profiled
+    def get(self, request: Request) -> Response:
+        errors: List[str] = []
+
+        url = parse_url(request, errors)
+        errors_so_far = len(errors)
+        space, max_distance = parse_colour_space(request, errors)
+        if len(errors) == errors_so_far and max_distance <= 0.0:
+            # the distance histogram needs a range to cover
+            errors.append("Invalid max distance")
+
+        max_size_str = request.query_params.get("max_size", None)
+        max_size: Optional[int] = settings.DEFAULT_COVERAGE_MAX_SIZE
+        if max_size_str == "full":
+            max_size = None
+        elif max_size_str is not None:
+            try:
+                max_size = int(max_size_str)
+                if max_size < 1:
+                    raise ValueError()
+            except ValueError:
+                errors.append("Invalid max size")
+
+        bins_str = request.query_params.get("bins", "10")
+        try:
+            bins = int(bins_str)
+            if not 1 <= bins <= 100:
+                raise ValueError()
+        except ValueError:
+            bins = 1  # for "might be referenced before assignment"
+            errors.append("Invalid number of bins")
+
+        if errors != []:
+            return Response({"errors": errors}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            # no point fetching the image if we'd only turn the request away once it arrives; the slot
+            # below still sheds requests if things got busier during the fetch
+            settings.COVERAGE_LIMITER.check()
+        except Overloaded as e:
+            return overloaded_response(e)
+
+        image_file = fetch_image(url)
+        if isinstance(image_file, Response):
+            return image_file
+
+        try:
+            with settings.COVERAGE_LIMITER.slot():
+                pil_image, icc_profile = open_image(image_file)
+                coverage = palette_coverage(
+                    pil_image,
+                    settings.COLOUR_MATCHERS[space],
+                    # the histogram covers distances up to max_distance; anything further is counted separately
+                    numpy.linspace(0.0, max_distance, bins + 1),
+                    max_size=max_size,
+                    workers=settings.COVERAGE_WORKERS,
+                    icc_profile=icc_profile,
+                )
+        except Overloaded as e:
+            return overloaded_response(e)
+        except PIL.UnidentifiedImageError:
+            return Response({"errors": ["Could not parse image"]}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(
+            {
+                "width": coverage.width,
+                "height": coverage.height,
+                "coverage": coverage.coverage,
+                "distances": {
+                    "mean": coverage.mean_distance,
+                    "max": coverage.max_distance,
+                    "bin_edges": coverage.distance_bin_edges,
+                    "counts": coverage.distance_counts,
+                    "over_max_distance": coverage.distance_overflow,
+                },
+            }
+        )
@@ -1,8 +1,15 @@
 import pytest
 from django.contrib.auth.models import User
+from django.core.cache import caches
 
 
 @pytest.mark.django_db
 @pytest.fixture()
 def admin_user() -> User:
     return User.objects.create_superuser("admin", "admin@example.com", "admin")
+
+
+@pytest.fixture(autouse=True)
+def clear_throttle_history() -> None:
+    # DRF's throttles keep their history in the cache, so stop tests using up each other's rate limits
+    caches["throttle"].clear()
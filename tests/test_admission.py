@@ -0,0 +1,85 @@
+import threading
+
+import pytest
+
+from closest_colour.admission import ConcurrencyLimiter, Overloaded
+
+
+def test_limiter_invalid_concurrency() -> None:
+    with pytest.raises(ValueError):
+        ConcurrencyLimiter(max_concurrency=0, latency_budget=1.0, initial_service_time=0.1)
+
+
+def test_limiter_tracks_in_flight() -> None:
+    limiter = ConcurrencyLimiter(max_concurrency=2, latency_budget=1.0, initial_service_time=0.1)
+    assert limiter.depth()["in_flight"] == 0
+    with limiter.slot():
+        assert limiter.depth()["in_flight"] == 1
+        assert limiter.estimated_wait() == 0.0
+        with limiter.slot():
+            assert limiter.depth()["in_flight"] == 2
+            # both slots are busy, so a new arrival would have to wait
+            assert limiter.estimated_wait() > 0.0
+    depth = limiter.depth()
+    assert depth["in_flight"] == 0
+    assert depth["waiting"] == 0
+
+
+def test_limiter_fast_fails_over_budget() -> None:
+    limiter = ConcurrencyLimiter(max_concurrency=1, latency_budget=1.0, initial_service_time=5.0)
+    with limiter.slot():
+        with pytest.raises(Overloaded) as excinfo:
+            with limiter.slot():
+                pass  # pragma: nocover
+    assert excinfo.value.retry_after == 5.0
+    assert excinfo.value.retry_after_header == "5"
+    assert limiter.depth()["in_flight"] == 0
+
+
+def test_limiter_check() -> None:
+    limiter = ConcurrencyLimiter(max_concurrency=1, latency_budget=1.0, initial_service_time=5.0)
+    limiter.check()
+    with limiter.slot():
+        with pytest.raises(Overloaded) as excinfo:
+            limiter.check()
+        assert excinfo.value.retry_after == 5.0
+        # checking doesn't take a slot or join the queue
+        assert limiter.depth()["in_flight"] == 1
+        assert limiter.depth()["waiting"] == 0
+
+
+def test_limiter_gives_up_at_deadline() -> None:
+    # the estimate says we will get in within budget, but the job in front never finishes
+    limiter = ConcurrencyLimiter(max_concurrency=1, latency_budget=0.05, initial_service_time=0.01)
+    with limiter.slot():
+        with pytest.raises(Overloaded):
+            with limiter.slot():
+                pass  # pragma: nocover
+        assert limiter.depth()["waiting"] == 0
+
+
+def test_limiter_waits_for_slot() -> None:
+    limiter = ConcurrencyLimiter(max_concurrency=1, latency_budget=5.0, initial_service_time=0.01)
+    entered = threading.Event()
+    release = threading.Event()
+
+    def hold_slot() -> None:
+        with limiter.slot():
+            entered.set()
+            release.wait()
+
+    thread = threading.Thread(target=hold_slot)
+    thread.start()
+    entered.wait()
+    threading.Timer(0.05, release.set).start()
+    with limiter.slot():
+        assert limiter.depth()["in_flight"] == 1
+    thread.join()
+
+
+def test_limiter_updates_service_time() -> None:
+    limiter = ConcurrencyLimiter(max_concurrency=1, latency_budget=1.0, initial_service_time=1.0, smoothing=0.5)
+    with limiter.slot():
+        pass
+    # the job took almost no time, so the average should have moved halfway towards zero
+    assert limiter.mean_service_time == pytest.approx(0.5, abs=0.01)
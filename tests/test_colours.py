@@ -1,13 +1,16 @@
 import random
 
+import numpy
 import pytest
 from colormath.color_conversions import convert_color
-from colormath.color_objects import LabColor, sRGBColor
+from colormath.color_objects import LabColor, XYZColor, sRGBColor
 
 from closest_colour.colours import (
     ColourMatcher,
+    KDTreeColourMatcher,
     LabKDTreeColourMatcher,
     SRGBKDTreeColourMatcher,
+    srgb_array_to_lab,
     webcolors_to_ours,
 )
 
@@ -96,3 +99,63 @@ def test_colour_matcher_sanity_nearby(matcher: ColourMatcher) -> None:
         blue += random.uniform(-0.1, 0.1)
         perturbed_colour = sRGBColor(red, green, blue)
         assert matcher.nearest(perturbed_colour)[0] == name
+
+
+@pytest.mark.parametrize(
+    "matcher", (SRGBKDTreeColourMatcher(TEST_COLOURS_SRGB), LabKDTreeColourMatcher(TEST_COLOURS_SRGB))
+)
+def test_colour_matcher_nearest_k(matcher: ColourMatcher) -> None:
+    for name, colour in TEST_COLOURS_SRGB.items():
+        nearest = matcher.nearest_k(colour, k=3)
+        assert len(nearest) == 3
+        assert nearest[0] == (name, 0.0)
+        assert nearest[0][1] <= nearest[1][1] <= nearest[2][1]
+    # asking for more colours than there are just gives all of them
+    assert len(matcher.nearest_k(sRGBColor(0.5, 0.5, 0.5), k=100)) == len(TEST_COLOURS_SRGB)
+
+
+def test_colour_matcher_nearest_k_duplicates() -> None:
+    matcher = SRGBKDTreeColourMatcher(
+        {
+            "gray": sRGBColor(0.5, 0.5, 0.5),
+            "grey": sRGBColor(0.5, 0.5, 0.5),
+            "white": sRGBColor(1.0, 1.0, 1.0),
+        }
+    )
+    nearest = matcher.nearest_k(sRGBColor(0.4, 0.4, 0.4), k=2)
+    # gray and grey are the same colour, so only one of them should be returned
+    assert [name for name, distance in nearest] == ["gray", "white"]
+
+
+def test_srgb_array_to_lab() -> None:
+    srgb = numpy.random.default_rng().random((100, 3))
+    # make sure both sides of the linear/gamma and cube root/linear thresholds are covered
+    srgb[0] = [0.0, 0.0, 0.0]
+    srgb[1] = [0.01, 0.02, 0.03]
+    srgb[2] = [1.0, 1.0, 1.0]
+    expected = [convert_color(sRGBColor(*colour), LabColor).get_value_tuple() for colour in srgb]
+    assert srgb_array_to_lab(srgb) == pytest.approx(numpy.asarray(expected))
+
+
+@pytest.mark.parametrize(
+    "matcher", (SRGBKDTreeColourMatcher(TEST_COLOURS_SRGB), LabKDTreeColourMatcher(TEST_COLOURS_SRGB))
+)
+def test_colour_matcher_nearest_srgb_array(matcher: ColourMatcher) -> None:
+    srgb = numpy.random.default_rng().random((50, 3))
+    distances, indices = matcher.nearest_srgb_array(srgb)
+    for colour, distance, index in zip(srgb, distances, indices):
+        expected_name, expected_distance = matcher.nearest(sRGBColor(*colour))
+        assert matcher.names[index] == expected_name
+        assert distance == pytest.approx(expected_distance)
+
+
+def test_colour_matcher_nearest_srgb_array_duplicates() -> None:
+    matcher = SRGBKDTreeColourMatcher({"gray": sRGBColor(0.5, 0.5, 0.5), "grey": sRGBColor(0.5, 0.5, 0.5)})
+    _, indices = matcher.nearest_srgb_array(numpy.full((10, 3), 0.5))
+    # duplicates are always reported under the first name
+    assert {matcher.names[index] for index in indices} == {"gray"}
+
+
+def test_colour_matcher_unsupported_colour_type() -> None:
+    with pytest.raises(ValueError):
+        KDTreeColourMatcher(TEST_COLOURS_SRGB, XYZColor)
@@ -0,0 +1,211 @@
+import json
+import os
+import random
+import threading
+from io import BytesIO, StringIO
+from pathlib import Path
+from typing import Any, Dict, Iterator
+
+import pytest
+import requests
+from django.conf import Settings, settings
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from PIL import Image
+from pytest_django.live_server_helper import LiveServer
+
+from closest_colour.admission import ConcurrencyLimiter
+from closest_colour.management.commands.loadtest import (
+    MAX_SYNTHETIC_SIDE,
+    Command,
+    ImageServer,
+    ProcessMonitor,
+    bursty_offsets,
+    replay_plan,
+)
+
+# Import conftest to make sure we have access to fixtures
+from . import conftest  # noqa: F401
+
+
+def test_benchmark_summarisers() -> None:
+    stdout = StringIO()
+    call_command(
+        "benchmark_summarisers",
+        str(settings.BASE_DIR / "images" / "1x1black.png"),
+        str(settings.BASE_DIR / "images" / "1x1white.png"),
+        summarisers=["mediancut", "octree"],
+        repeat=1,
+        stdout=stdout,
+    )
+    lines = stdout.getvalue().splitlines()
+    for line, name in zip(lines[-2:], ("mediancut", "octree")):
+        _, cpu_ms, summarise_ms, agrees = line.split()
+        assert line.split()[0] == name
+        assert 0.0 <= float(summarise_ms) <= float(cpu_ms)
+        assert agrees == "2/2"
+
+
+def test_benchmark_summarisers_reference_agrees_with_itself() -> None:
+    # k-means is seeded, so comparing it with itself should always agree, even on noise
+    stdout = StringIO()
+    call_command(
+        "benchmark_summarisers",
+        str(settings.BASE_DIR / "images" / "hsvnoise.png"),
+        summarisers=["kmeans"],
+        repeat=1,
+        stdout=stdout,
+    )
+    assert stdout.getvalue().splitlines()[-1].split()[-1] == "1/1"
+
+
+def test_benchmark_summarisers_unknown_summariser() -> None:
+    with pytest.raises(CommandError):
+        call_command("benchmark_summarisers", summarisers=["wharblgarbl"], stdout=StringIO())
+
+
+@pytest.fixture()
+def image_server() -> Iterator[ImageServer]:
+    server = ImageServer(settings.BASE_DIR / "images")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_image_server(image_server: ImageServer) -> None:
+    sample = requests.get(f"{image_server.base_url}/images/1x1black.png")
+    assert sample.status_code == 200
+    assert sample.content == (settings.BASE_DIR / "images" / "1x1black.png").read_bytes()
+
+    synthetic = requests.get(f"{image_server.base_url}/synthetic/30x20.png")
+    assert synthetic.status_code == 200
+    assert Image.open(BytesIO(synthetic.content)).size == (30, 20)
+
+    for path in (
+        "/images/../manage.py",
+        "/images/wharblgarbl.png",
+        "/synthetic/axb.png",
+        "/synthetic/0x10.png",
+        f"/synthetic/{MAX_SYNTHETIC_SIDE + 1}x10.png",
+        "/wharblgarbl",
+    ):
+        assert requests.get(f"{image_server.base_url}{path}").status_code == 404
+
+
+def test_bursty_offsets() -> None:
+    rng = random.Random(0)
+    offsets = bursty_offsets(rate=1.0, burst_rate=100.0, burst_length=1.0, burst_interval=10.0, duration=20.0, rng=rng)
+    assert offsets == sorted(offsets)
+    assert all(0.0 <= offset < 20.0 for offset in offsets)
+    # nearly all of the requests should be in the two bursts
+    in_bursts = [offset for offset in offsets if offset < 1.0 or 10.0 <= offset < 11.0]
+    assert len(in_bursts) > 0.8 * len(offsets)
+
+
+def test_bursty_offsets_bursts_only() -> None:
+    rng = random.Random(0)
+    offsets = bursty_offsets(rate=0.0, burst_rate=100.0, burst_length=1.0, burst_interval=10.0, duration=20.0, rng=rng)
+    assert len(offsets) > 0
+    assert all(offset < 1.0 or 10.0 <= offset < 11.0 for offset in offsets)
+
+
+def plan_options(**options: Any) -> Dict[str, Any]:
+    return {
+        "pattern": "steady",
+        "rate": 10.0,
+        "duration": 1.0,
+        "burst_rate": 10.0,
+        "burst_length": 1.0,
+        "burst_interval": 10.0,
+        "seed": 0,
+        "images": None,
+        **options,
+    }
+
+
+def test_make_plan_prepares_synthetic_images(image_server: ImageServer) -> None:
+    plan = Command.make_plan(plan_options(images=["synthetic/30x20.png"]), image_server, {})
+    assert len(plan) > 0
+    # made before the clock starts, rather than on the first request for it
+    assert (30, 20) in image_server._synthetic
+
+
+@pytest.mark.parametrize(
+    "options,message",
+    (
+        ({"rate": -1.0}, "--rate can't be negative"),
+        ({"pattern": "bursty", "burst_rate": -1.0}, "--burst-rate can't be negative"),
+        ({"duration": -1.0}, "--duration can't be negative"),
+        ({"pattern": "bursty", "burst_length": -1.0}, "--burst-length can't be negative"),
+        ({"pattern": "bursty", "burst_interval": 0.0}, "--burst-interval must be more than 0"),
+        ({"images": [f"synthetic/{MAX_SYNTHETIC_SIDE + 1}x10.png"]}, "Invalid synthetic image"),
+    ),
+)
+def test_make_plan_invalid(image_server: ImageServer, options: Dict[str, Any], message: str) -> None:
+    with pytest.raises(CommandError, match=message):
+        Command.make_plan(plan_options(**options), image_server, {})
+
+
+def test_replay_plan() -> None:
+    lines = [
+        '{"offset": 2.0, "image": "1x1black.png"}',
+        "",
+        '{"offset": 1.0, "image": "synthetic/10x10.png", "params": {"summariser": "mean"}}',
+        '{"offset": 3.0, "url": "http://example.com/image.png"}',
+    ]
+    plan = replay_plan(lines, "http://images.test")
+    assert [planned.offset for planned in plan] == [1.0, 2.0, 3.0]
+    assert [planned.image_url for planned in plan] == [
+        "http://images.test/synthetic/10x10.png",
+        "http://images.test/images/1x1black.png",
+        "http://example.com/image.png",
+    ]
+    assert plan[0].params == {"summariser": "mean"}
+
+
+def test_replay_plan_invalid() -> None:
+    with pytest.raises(CommandError):
+        replay_plan(['{"image": "1x1black.png"}'], "http://images.test")
+
+
+def test_process_monitor() -> None:
+    monitor = ProcessMonitor([os.getpid()], interval=0.01)
+    monitor.start()
+    sum(range(1000000))
+    report = monitor.stop()[str(os.getpid())]
+    assert report["cpu_seconds"] is not None and report["cpu_seconds"] > 0.0
+    assert report["peak_rss_mib"] is not None and report["peak_rss_mib"] > 0.0
+
+
+@pytest.mark.django_db(transaction=True)
+def test_loadtest(live_server: LiveServer, admin_user: User, tmp_path: Path, settings: Settings) -> None:
+    # the live server runs in this process, so uses these settings; on a machine with few cores the usual
+    # limiter would (quite rightly) shed some of this load, which isn't what's being tested here
+    setattr(
+        settings,
+        "SUMMARISE_LIMITER",
+        ConcurrencyLimiter(max_concurrency=4, latency_budget=60.0, initial_service_time=0.01),
+    )
+    output = tmp_path / "report.json"
+    call_command(
+        "loadtest",
+        target=live_server.url,
+        user="admin:admin",
+        rate=20.0,
+        duration=0.5,
+        seed=0,
+        images=["1x1black.png", "synthetic/16x16.png"],
+        param=["summariser=mean"],
+        worker_pid=[os.getpid()],
+        label="live_server",
+        output=output,
+        stdout=StringIO(),
+    )
+    report = json.loads(output.read_text())
+    assert report["label"] == "live_server"
+    assert report["requests"] > 0
+    assert report["error_rate"] == 0.0
+    assert set(report["statuses"]) <= {"200", "404"}
+    assert report["latency_seconds"]["p50"] <= report["latency_seconds"]["p99"] <= report["latency_seconds"]["max"]
+    assert str(os.getpid()) in report["workers"]
@@ -0,0 +1,80 @@
+from typing import Any, List, Optional, Tuple
+
+import numpy
+import pytest
+from django.conf import settings
+from PIL import Image, ImageCms
+
+from closest_colour.colours import LabKDTreeColourMatcher, SRGBKDTreeColourMatcher
+from closest_colour.coverage import palette_coverage
+
+from .test_colours import TEST_COLOURS_SRGB
+
+
+def test_palette_coverage_halves() -> None:
+    # left half black, right half very nearly white
+    image = Image.new("RGB", (10, 4), (0, 0, 0))
+    image.paste((250, 250, 250), (5, 0, 10, 4))
+    matcher = SRGBKDTreeColourMatcher(TEST_COLOURS_SRGB)
+    coverage = palette_coverage(image, matcher, numpy.linspace(0.0, 0.2, 5), chunk_pixels=7)
+    assert (coverage.width, coverage.height) == (10, 4)
+    assert coverage.coverage == {"black": 0.5, "white": 0.5}
+    off_white_distance = (3 * (5 / 255) ** 2) ** 0.5
+    assert coverage.max_distance == pytest.approx(off_white_distance)
+    assert coverage.mean_distance == pytest.approx(off_white_distance / 2)
+    assert coverage.distance_bin_edges == pytest.approx([0.0, 0.05, 0.1, 0.15, 0.2])
+    assert coverage.distance_counts == [40, 0, 0, 0]
+    assert coverage.distance_overflow == 0
+
+
+def test_palette_coverage_overflow() -> None:
+    image = Image.new("RGB", (3, 3), (0, 0, 0))
+    image.putpixel((1, 1), (255, 128, 64))
+    matcher = SRGBKDTreeColourMatcher(TEST_COLOURS_SRGB)
+    coverage = palette_coverage(image, matcher, numpy.linspace(0.0, 0.1, 3))
+    assert coverage.distance_counts == [8, 0]
+    assert coverage.distance_overflow == 1
+    assert sum(coverage.coverage.values()) == pytest.approx(1.0)
+
+
+def test_palette_coverage_max_size() -> None:
+    image = Image.new("RGBA", (400, 100), (0, 128, 128, 255))
+    matcher = LabKDTreeColourMatcher(TEST_COLOURS_SRGB)
+    coverage = palette_coverage(image, matcher, numpy.linspace(0.0, 10.0, 11), max_size=40)
+    # the aspect ratio is kept when scaling down
+    assert (coverage.width, coverage.height) == (40, 10)
+    assert coverage.coverage == {"teal": 1.0}
+    assert coverage.max_distance == pytest.approx(0.0, abs=1e-6)
+
+
+@pytest.mark.parametrize("chunk_pixels", (1, 1000, 1000000))
+def test_palette_coverage_chunk_size(chunk_pixels: int) -> None:
+    # the answer shouldn't depend on how the image is split up
+    image = Image.open(settings.BASE_DIR / "images" / "hsvnoise.png")
+    matcher = SRGBKDTreeColourMatcher(TEST_COLOURS_SRGB)
+    edges = numpy.linspace(0.0, 0.2, 11)
+    expected = palette_coverage(image, matcher, edges, max_size=50)
+    actual = palette_coverage(image, matcher, edges, max_size=50, chunk_pixels=chunk_pixels)
+    assert actual.coverage == pytest.approx(expected.coverage)
+    assert actual.distance_counts == expected.distance_counts
+    assert actual.mean_distance == pytest.approx(expected.mean_distance)
+
+
+def test_palette_coverage_transforms_strips(monkeypatch: pytest.MonkeyPatch) -> None:
+    # the profile is applied to scaled down strips, not the full-size image
+    transformed_sizes: List[Tuple[int, int]] = []
+    apply_transform = ImageCms.applyTransform
+
+    def record_size(image: Image.Image, transform: ImageCms.ImageCmsTransform, *args: Any) -> Optional[Image.Image]:
+        transformed_sizes.append(image.size)
+        return apply_transform(image, transform, *args)
+
+    monkeypatch.setattr(ImageCms, "applyTransform", record_size)
+    icc_profile = Image.open(settings.BASE_DIR / "images" / "1x1black.png").info["icc_profile"]
+    image = Image.new("RGB", (400, 100), (0, 128, 128))
+    matcher = SRGBKDTreeColourMatcher(TEST_COLOURS_SRGB)
+    coverage = palette_coverage(
+        image, matcher, numpy.linspace(0.0, 0.2, 3), max_size=40, chunk_pixels=200, icc_profile=icc_profile
+    )
+    assert coverage.coverage == {"teal": 1.0}
+    assert transformed_sizes == [(40, 5), (40, 5)]
@@ -1,16 +1,28 @@
-from typing import List, Optional
+import struct
+from io import BytesIO
+from typing import Any, List, Optional, Tuple
 
 import numpy
 import pytest
 from colormath.color_objects import sRGBColor
 from django.conf import settings
+from PIL import Image, ImageCms
 
+from closest_colour.colours import SRGBKDTreeColourMatcher
 from closest_colour.images import (
+    SOURCE_MODES,
+    IccTransformCache,
     ImageColourSummariser,
     KMeansImageColourSummariser,
     MeanImageColourSummariser,
+    ProgressiveImageColourSummariser,
+    QuantizeImageColourSummariser,
+    convert_to_srgb,
+    open_image,
 )
 
+from .test_colours import TEST_COLOURS_SRGB
+
 
 @pytest.mark.parametrize("resize_to", (1, None))
 @pytest.mark.parametrize(
@@ -29,7 +41,16 @@ def test_image_file_to_numpy_array_200x200() -> None:
     assert numpy.array_equal(array, numpy.ones((200, 200, 3)))
 
 
-@pytest.mark.parametrize("summariser", (MeanImageColourSummariser(), KMeansImageColourSummariser()))
+@pytest.mark.parametrize(
+    "summariser",
+    (
+        MeanImageColourSummariser(),
+        KMeansImageColourSummariser(),
+        ProgressiveImageColourSummariser(),
+        QuantizeImageColourSummariser(Image.Quantize.MEDIANCUT),
+        QuantizeImageColourSummariser(Image.Quantize.FASTOCTREE),
+    ),
+)
 @pytest.mark.parametrize(
     "filename,expected_colour",
     (("1x1white.png", sRGBColor(1.0, 1.0, 1.0)), ("1x1black.png", sRGBColor(0.0, 0.0, 0.0))),
@@ -79,3 +100,350 @@ def test_kmeans_image_summariser_regression(filename: str, expected_colour: sRGB
         (actual_blue, expected_blue),
     ]:
         assert abs(actual - expected) < tolerance
+
+
+def test_progressive_image_summariser_no_tiers() -> None:
+    with pytest.raises(ValueError):
+        ProgressiveImageColourSummariser(tiers=())
+
+
+def test_progressive_image_summariser_easy_image() -> None:
+    summariser = ProgressiveImageColourSummariser()
+    image_file = BytesIO()
+    Image.new("RGB", (300, 300), (0, 128, 128)).save(image_file, format="PNG")
+    image_file.seek(0)
+    summary = summariser.summarise_progressively(
+        image_file, matcher=SRGBKDTreeColourMatcher(TEST_COLOURS_SRGB), max_distance=0.2
+    )
+    # a flat colour is easy enough to get right from the smallest thumbnail
+    assert len(summary.tiers) == 1
+    assert summary.tiers[0].resize_to == 16
+    assert summary.tiers[0].dominant_share == 1.0
+    assert not summary.tiers[0].ambiguous
+    assert summary.colour.get_value_tuple() == pytest.approx((0.0, 128 / 255, 128 / 255))
+
+
+def test_progressive_image_summariser_escalates() -> None:
+    # nothing will ever cover the whole image, so every tier is ambiguous and we must try them all
+    summariser = ProgressiveImageColourSummariser(tiers=(16, 64, 200), min_dominant_share=1.1)
+    image_file = open(settings.BASE_DIR / "images" / "test-sample-teal.png", "rb")
+    summary = summariser.summarise_progressively(image_file)
+    assert [tier.resize_to for tier in summary.tiers] == [16, 64, 200]
+    assert all(tier.ambiguous for tier in summary.tiers)
+    assert all(tier.seconds > 0.0 for tier in summary.tiers)
+
+
+def test_progressive_image_summariser_bounded_by_default() -> None:
+    # even when every tier is ambiguous, don't run k-means on the full-size image
+    summariser = ProgressiveImageColourSummariser(min_dominant_share=1.1)
+    image_file = open(settings.BASE_DIR / "images" / "test-sample-teal.png", "rb")
+    summary = summariser.summarise_progressively(image_file)
+    assert [tier.resize_to for tier in summary.tiers] == [16, 64, 200, 1000]
+
+
+def test_progressive_image_summariser_full_size_for_small_images() -> None:
+    summariser = ProgressiveImageColourSummariser(min_dominant_share=1.1)
+    image_file = open(settings.BASE_DIR / "images" / "1x1white.png", "rb")
+    summary = summariser.summarise_progressively(image_file)
+    # the 1x1 image is smaller than the first tier, so is summarised at its own size, and only once
+    assert [tier.resize_to for tier in summary.tiers] == [None]
+    assert summary.colour.get_value_tuple() == (1.0, 1.0, 1.0)
+
+
+def test_progressive_image_summariser_fixed_size() -> None:
+    summariser = ProgressiveImageColourSummariser()
+    image_file = open(settings.BASE_DIR / "images" / "1x1black.png", "rb")
+    assert summariser.summarise(image_file, resize_to=8).get_value_tuple() == (0.0, 0.0, 0.0)
+
+
+@pytest.mark.parametrize(
+    "colour,dominant_share,max_distance,expected",
+    (
+        # plainly teal, nowhere near the cutoff
+        (sRGBColor(0.0, 0.5, 0.5), 0.9, 0.2, False),
+        # most popular cluster is too small
+        (sRGBColor(0.0, 0.5, 0.5), 0.3, 0.2, True),
+        # just inside the cutoff
+        (sRGBColor(0.0, 0.5, 0.69), 0.9, 0.2, True),
+        # about halfway between teal and aqua
+        (sRGBColor(0.0, 0.75, 0.75), 0.9, None, True),
+        (sRGBColor(0.0, 0.75, 0.75), 0.9, 1.0, True),
+    ),
+)
+def test_progressive_image_summariser_is_ambiguous(
+    colour: sRGBColor, dominant_share: float, max_distance: Optional[float], expected: bool
+) -> None:
+    summariser = ProgressiveImageColourSummariser()
+    matcher = SRGBKDTreeColourMatcher(TEST_COLOURS_SRGB)
+    assert summariser.is_ambiguous(colour, dominant_share, matcher=matcher, max_distance=max_distance) == expected
+
+
+@pytest.mark.parametrize(
+    "filename,expected_tiers",
+    (
+        # most images are easy, and done with at the cheapest tier
+        ("test-sample-teal.png", [16]),
+        ("black-square-white-bg.png", [16]),
+        # close to max_distance, so tries one more tier, which agrees
+        ("test-sample-navy.png", [16, 64]),
+        # no colour ever covers half of the noise, so however much the tiers agree, try them all
+        ("hsvnoise.png", [16, 64, 200, None]),
+    ),
+)
+def test_progressive_image_summariser_tiers(filename: str, expected_tiers: List[Optional[int]]) -> None:
+    summariser = ProgressiveImageColourSummariser()
+    image_file = open(settings.BASE_DIR / "images" / filename, "rb")
+    summary = summariser.summarise_progressively(
+        image_file, matcher=settings.COLOUR_MATCHERS["srgb"], max_distance=settings.DEFAULT_MAX_DISTANCES["srgb"]
+    )
+    assert [tier.resize_to for tier in summary.tiers] == expected_tiers
+
+
+@pytest.mark.parametrize(
+    "filename,expected_colour_name",
+    (
+        ("test-sample-navy.png", "navy"),
+        ("test-sample-teal.png", "teal"),
+        ("black-square-white-bg.png", "black"),
+    ),
+)
+def test_progressive_image_summariser_matches_kmeans(filename: str, expected_colour_name: str) -> None:
+    summariser = ProgressiveImageColourSummariser()
+    matcher = SRGBKDTreeColourMatcher(TEST_COLOURS_SRGB)
+    image_file = open(settings.BASE_DIR / "images" / filename, "rb")
+    summary = summariser.summarise_progressively(image_file, matcher=matcher, max_distance=0.2)
+    assert matcher.nearest(summary.colour)[0] == expected_colour_name
+
+
+@pytest.mark.parametrize("method", (Image.Quantize.MEDIANCUT, Image.Quantize.FASTOCTREE))
+@pytest.mark.parametrize(
+    "filename,expected_colour",
+    (
+        ("test-sample-black.png", sRGBColor(36, 36, 36, is_upscaled=True)),
+        ("test-sample-grey.png", sRGBColor(56, 70, 87, is_upscaled=True)),
+        ("test-sample-navy.png", sRGBColor(0, 0, 80, is_upscaled=True)),
+        ("test-sample-teal.png", sRGBColor(0, 98, 110, is_upscaled=True)),
+    ),
+)
+def test_quantize_image_summariser_regression(
+    filename: str, expected_colour: sRGBColor, method: Image.Quantize
+) -> None:
+    summariser = QuantizeImageColourSummariser(method)
+    image_file = open(settings.BASE_DIR / "images" / filename, "rb")
+    # the quantizers are deterministic, but median cut and octree pick slightly different colours
+    actual_colour = summariser.summarise(image_file)
+    assert actual_colour.get_value_tuple() == pytest.approx(expected_colour.get_value_tuple(), abs=0.02)
+
+
+def test_quantize_image_summariser_palette_image() -> None:
+    # quantizing needs an RGB image, so anything else has to be converted first
+    image_file = BytesIO()
+    Image.new("RGB", (10, 10), (0, 128, 128)).convert("P", palette=Image.Palette.ADAPTIVE).save(
+        image_file, format="PNG"
+    )
+    image_file.seek(0)
+    actual_colour = QuantizeImageColourSummariser().summarise(image_file)
+    assert actual_colour.get_upscaled_value_tuple() == (0, 128, 128)
+
+
+def image_file_of(image: Image.Image, format: str = "PNG", **save_options: Any) -> BytesIO:
+    image_file = BytesIO()
+    image.save(image_file, format=format, **save_options)
+    image_file.seek(0)
+    return image_file
+
+
+def srgb_image_of(image_file: BytesIO, **convert_options: Any) -> Image.Image:
+    pil_image, icc_profile = open_image(image_file)
+    assert pil_image.mode in SOURCE_MODES
+    return convert_to_srgb(pil_image, icc_profile, **convert_options)
+
+
+def linear_grey_icc_profile() -> bytes:
+    # a minimal v2 greyscale display profile with a linear tone curve, so we can tell when it's been applied
+    def s15fixed16(value: float) -> bytes:
+        return struct.pack(">i", round(value * 65536))
+
+    d50 = s15fixed16(0.9642) + s15fixed16(1.0) + s15fixed16(0.8249)
+    tags = [(b"wtpt", b"XYZ " + bytes(4) + d50), (b"kTRC", b"curv" + bytes(4) + struct.pack(">IH", 1, 256) + bytes(2))]
+    offset = 128 + 4 + 12 * len(tags)
+    tag_table, tag_data = b"", b""
+    for signature, body in tags:
+        tag_table += signature + struct.pack(">II", offset + len(tag_data), len(body))
+        tag_data += body
+    header = (
+        struct.pack(">I", offset + len(tag_data))
+        + bytes(4)
+        + bytes([2, 0x10, 0, 0])
+        + b"mntrGRAYXYZ "
+        + bytes(12)
+        + b"acsp"
+        + bytes(28)
+        + d50
+        + bytes(48)
+    )
+    return header + struct.pack(">I", len(tags)) + tag_table + tag_data
+
+
+@pytest.mark.parametrize(
+    "image,expected_mode,expected_pixel",
+    (
+        (Image.new("RGB", (2, 2), (0, 128, 128)), "RGB", (0, 128, 128)),
+        (Image.new("L", (2, 2), 100), "L", (100, 100, 100)),
+        (Image.new("1", (2, 2), 1), "L", (255, 255, 255)),
+        (
+            Image.new("RGB", (2, 2), (0, 128, 128)).convert("P", palette=Image.Palette.ADAPTIVE),
+            "RGBA",
+            (0, 128, 128),
+        ),
+        # fully transparent, so we should see the white background
+        (Image.new("RGBA", (2, 2), (0, 0, 0, 0)), "RGBA", (255, 255, 255)),
+        # half transparent black over white
+        (Image.new("RGBA", (2, 2), (0, 0, 0, 128)), "RGBA", (127, 127, 127)),
+        (Image.new("LA", (2, 2), (0, 0)), "LA", (255, 255, 255)),
+        # 16-bit greyscale should be scaled down rather than clipped to white
+        (Image.fromarray(numpy.full((2, 2), 128 * 256, dtype=numpy.uint16)), "L", (128, 128, 128)),
+    ),
+)
+def test_open_image_modes(image: Image.Image, expected_mode: str, expected_pixel: Tuple[int, int, int]) -> None:
+    pil_image, icc_profile = open_image(image_file_of(image))
+    assert pil_image.mode == expected_mode
+    assert icc_profile is None
+    srgb_image = convert_to_srgb(pil_image, icc_profile)
+    assert srgb_image.mode == "RGB"
+    assert srgb_image.getpixel((0, 0)) == expected_pixel
+
+
+def test_open_image_dark_16_bit() -> None:
+    # scaling shouldn't depend on the values actually used, so dark images stay dark
+    image = Image.fromarray(numpy.array([[200, 256, 32768, 65535]], dtype=numpy.uint16))
+    srgb_image = srgb_image_of(image_file_of(image))
+    assert [srgb_image.getpixel((x, 0)) for x in range(4)] == [(0, 0, 0), (1, 1, 1), (128, 128, 128), (255, 255, 255)]
+
+
+def test_open_image_transparent_colour() -> None:
+    image = Image.new("RGB", (2, 1), (0, 0, 0))
+    image.putpixel((1, 0), (0, 128, 128))
+    srgb_image = srgb_image_of(image_file_of(image, transparency=(0, 0, 0)))
+    assert srgb_image.getpixel((0, 0)) == (255, 255, 255)
+    assert srgb_image.getpixel((1, 0)) == (0, 128, 128)
+
+
+def test_open_image_transparent_grey_keeps_profile() -> None:
+    image = Image.new("L", (2, 1), 0)
+    image.putpixel((1, 0), 100)
+    image_file = image_file_of(image, transparency=0, icc_profile=linear_grey_icc_profile())
+    pil_image, icc_profile = open_image(image_file)
+    # promoting this to RGBA would leave us with a greyscale profile we can't apply
+    assert pil_image.mode == "LA"
+    srgb_image = convert_to_srgb(pil_image, icc_profile, transforms=IccTransformCache())
+    assert srgb_image.getpixel((0, 0)) == (255, 255, 255)
+    # 100 on a linear tone curve is a good deal lighter in sRGB
+    assert srgb_image.getpixel((1, 0)) == pytest.approx((168, 168, 168), abs=1)
+
+
+def test_open_image_cmyk() -> None:
+    srgb_image = srgb_image_of(image_file_of(Image.new("CMYK", (2, 2), (255, 0, 0, 0)), format="JPEG"))
+    assert srgb_image.mode == "RGB"
+    red, green, blue = srgb_image.getpixel((0, 0))
+    # without a profile this is only approximate, but it should at least be cyan
+    assert red < 10 and green > 245 and blue > 245
+
+
+@pytest.mark.parametrize(
+    "lab,expected_pixel",
+    (
+        # neutral mid grey (a* and b* are stored offset by 128)
+        ((128, 128, 128), (119, 119, 119)),
+        ((128, 188, 168), (214, 60, 56)),
+    ),
+)
+def test_open_image_lab(lab: Tuple[int, int, int], expected_pixel: Tuple[int, int, int]) -> None:
+    pil_image, icc_profile = open_image(image_file_of(Image.new("LAB", (2, 2), lab), format="TIFF"))
+    assert pil_image.mode == "LAB"
+    srgb_image = convert_to_srgb(pil_image, icc_profile, transforms=IccTransformCache())
+    assert srgb_image.getpixel((0, 0)) == pytest.approx(expected_pixel, abs=2)
+
+
+def test_convert_to_srgb_background() -> None:
+    srgb_image = srgb_image_of(image_file_of(Image.new("RGBA", (2, 2), (0, 0, 0, 0))), background=(0, 0, 255))
+    assert srgb_image.getpixel((0, 0)) == (0, 0, 255)
+
+
+def test_convert_to_srgb_icc_profile() -> None:
+    icc_profile = Image.open(settings.BASE_DIR / "images" / "1x1black.png").info["icc_profile"]
+    transforms = IccTransformCache()
+    for colour in ((0, 128, 128), (255, 0, 0)):
+        image_file = image_file_of(Image.new("RGB", (2, 2), colour), icc_profile=icc_profile)
+        srgb_image = srgb_image_of(image_file, transforms=transforms)
+        # the profile is sRGB, so the colours shouldn't change (much)
+        assert srgb_image.getpixel((0, 0)) == pytest.approx(colour, abs=1)
+    # both images have the same profile, so should have used the same transform
+    assert len(transforms) == 1
+
+
+def test_convert_to_srgb_broken_icc_profile() -> None:
+    image_file = image_file_of(Image.new("RGB", (2, 2), (0, 128, 128)), icc_profile=b"wharblgarbl")
+    assert srgb_image_of(image_file, transforms=IccTransformCache()).getpixel((0, 0)) == (0, 128, 128)
+
+
+def test_icc_transform_cache_lru(monkeypatch: pytest.MonkeyPatch) -> None:
+    built: List[str] = []
+
+    def build_transform(input_profile: Any, output_profile: Any, input_mode: str, *args: Any, **kwargs: Any) -> object:
+        built.append(input_mode)
+        return object()
+
+    monkeypatch.setattr(ImageCms, "buildTransform", build_transform)
+    monkeypatch.setattr(ImageCms, "ImageCmsProfile", lambda profile: profile)
+    transforms = IccTransformCache(maxsize=2)
+    first = transforms.get(b"first", "RGB")
+    transforms.get(b"second", "RGB")
+    # using the first profile again makes the second one the least recently used
+    assert transforms.get(b"first", "RGB") is first
+    transforms.get(b"third", "CMYK")
+    assert len(transforms) == 2
+    assert built == ["RGB", "RGB", "CMYK"]
+    transforms.get(b"second", "RGB")
+    assert built == ["RGB", "RGB", "CMYK", "RGB"]
+
+
+@pytest.mark.parametrize(
+    "summariser",
+    (
+        MeanImageColourSummariser(),
+        KMeansImageColourSummariser(),
+        ProgressiveImageColourSummariser(),
+        QuantizeImageColourSummariser(),
+    ),
+)
+def test_image_summariser_rgba(summariser: ImageColourSummariser) -> None:
+    # a transparent image used to break sRGBColor(*mean) by having four channels
+    image_file = image_file_of(Image.new("RGBA", (50, 50), (0, 0, 0, 0)))
+    assert summariser.summarise(image_file).get_value_tuple() == pytest.approx((1.0, 1.0, 1.0))
+
+
+@pytest.mark.parametrize(
+    "summariser,expected_size",
+    (
+        (KMeansImageColourSummariser(), (200, 200)),
+        (ProgressiveImageColourSummariser(), (16, 16)),
+        (QuantizeImageColourSummariser(), (200, 200)),
+    ),
+)
+def test_image_summariser_transforms_thumbnail(
+    monkeypatch: pytest.MonkeyPatch, summariser: ImageColourSummariser, expected_size: Tuple[int, int]
+) -> None:
+    # applying the profile to the full-size image would cost far more than summarising the thumbnail
+    transformed_sizes: List[Tuple[int, int]] = []
+    apply_transform = ImageCms.applyTransform
+
+    def record_size(image: Image.Image, transform: ImageCms.ImageCmsTransform, *args: Any) -> Optional[Image.Image]:
+        transformed_sizes.append(image.size)
+        return apply_transform(image, transform, *args)
+
+    monkeypatch.setattr(ImageCms, "applyTransform", record_size)
+    icc_profile = Image.open(settings.BASE_DIR / "images" / "1x1black.png").info["icc_profile"]
+    image_file = image_file_of(Image.new("RGB", (1000, 800), (0, 128, 128)), icc_profile=icc_profile)
+    summariser.summarise(image_file)
+    assert transformed_sizes == [expected_size]
@@ -0,0 +1,82 @@
+from pathlib import Path
+
+import numpy
+import pytest
+
+from closest_colour.profiling import RequestProfiler
+
+
+def test_should_profile_header() -> None:
+    profiler = RequestProfiler(Path("unused"), sample_rate=0.0)
+    assert not profiler.should_profile({}, is_staff=True)
+    assert profiler.should_profile({"X-Profile": "1"}, is_staff=True)
+    # ordinary users can't ask for profiling
+    assert not profiler.should_profile({"X-Profile": "1"}, is_staff=False)
+
+
+def test_should_profile_no_header() -> None:
+    profiler = RequestProfiler(Path("unused"), sample_rate=0.0, header=None)
+    assert not profiler.should_profile({"X-Profile": "1"}, is_staff=True)
+    assert not profiler.should_trace_memory({"X-Profile": "memory"})
+
+
+def test_should_profile_sampled() -> None:
+    assert RequestProfiler(Path("unused"), sample_rate=1.0).should_profile({}, is_staff=False)
+
+
+def test_should_trace_memory() -> None:
+    profiler = RequestProfiler(Path("unused"))
+    assert not profiler.should_trace_memory({"X-Profile": "1"})
+    assert profiler.should_trace_memory({"X-Profile": "Memory"})
+    assert RequestProfiler(Path("unused"), trace_memory=True).should_trace_memory({})
+
+
+def test_profile_writes_dumps(tmp_path: Path) -> None:
+    profiler = RequestProfiler(tmp_path)
+    with profiler.profile("Test"):
+        numpy.ones((100, 100)).sum()
+    assert len(list(tmp_path.glob("*-Test-*.pstats"))) == 1
+    (summary,) = tmp_path.glob("*-Test-*.txt")
+    assert "Test took" in summary.read_text()
+    assert "peak traced memory" not in summary.read_text()
+
+
+def test_profile_traces_memory(tmp_path: Path) -> None:
+    profiler = RequestProfiler(tmp_path)
+    with profiler.profile("Test", trace_memory=True):
+        # 8MB of float64s, which is freed again before the end
+        numpy.ones((1000, 1000)).sum()
+    (summary,) = tmp_path.glob("*.txt")
+    peak_line = summary.read_text().splitlines()[2]
+    assert peak_line.startswith("peak traced memory: ")
+    assert float(peak_line.split()[3]) >= 7.5
+
+
+def test_profile_rotates(tmp_path: Path) -> None:
+    profiler = RequestProfiler(tmp_path, max_dumps=2)
+    for number in range(4):
+        with profiler.profile(f"Test{number}"):
+            pass
+    assert len(list(tmp_path.glob("*.pstats"))) == 2
+    assert len(list(tmp_path.glob("*.txt"))) == 2
+    # all written within the same second, but it's still the oldest that are removed
+    assert sorted(path.name.split("-")[1] for path in tmp_path.glob("*.pstats")) == ["Test2", "Test3"]
+
+
+def test_profile_write_failure(tmp_path: Path, caplog: pytest.LogCaptureFixture) -> None:
+    # a file where the profiles directory should be, so it can't be created
+    directory = tmp_path / "profiles"
+    directory.write_text("not a directory")
+    profiler = RequestProfiler(directory)
+    with profiler.profile("test"):
+        pass
+    assert "Could not write profile of test" in caplog.text
+
+
+def test_profile_write_failure_keeps_exception(tmp_path: Path) -> None:
+    directory = tmp_path / "profiles"
+    directory.write_text("not a directory")
+    profiler = RequestProfiler(directory)
+    with pytest.raises(ZeroDivisionError):
+        with profiler.profile("test"):
+            1 / 0
@@ -1,17 +1,35 @@
+import re
+from contextlib import ExitStack
+from io import BytesIO
+from pathlib import Path
+from typing import Any, List
+
 import pytest
 from django.conf import Settings
 from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from PIL import Image
 from requests_mock import Mocker
 from rest_framework.test import APIRequestFactory, force_authenticate
 
+from closest_colour.admission import ConcurrencyLimiter
 from closest_colour.colours import SRGBKDTreeColourMatcher
-from closest_colour.views import MatchColour
+from closest_colour.profiling import RequestProfiler
+from closest_colour.views import (
+    AdmissionStatus,
+    MatchColour,
+    MatchColourThrottle,
+    PaletteCoverage,
+    PaletteCoverageThrottle,
+)
 
 # Import conftest to make sure we have access to fixtures
 from . import conftest  # noqa: F401
 from .test_colours import TEST_COLOURS_SRGB
 
 PATH = "/colours/match"
+COVERAGE_PATH = "/colours/coverage"
 
 
 def test_view_unauthenticated() -> None:
@@ -162,3 +180,219 @@ def test_view_samples(
         assert response.data["colour"] == expected_colour_name
         tolerance = 0.05
         assert abs(response.data["distance"] - expected_distance) < tolerance
+
+
+@pytest.mark.django_db
+def test_view_overloaded(admin_user: User, settings: Settings, requests_mock: Mocker) -> None:
+    limiter = ConcurrencyLimiter(max_concurrency=1, latency_budget=1.0, initial_service_time=2.5)
+    setattr(settings, "SUMMARISE_LIMITER", limiter)
+
+    url = "http://test-colour-matching.test/1x1black.png"
+    requests_mock.get(url, content=open(getattr(settings, "BASE_DIR") / "images" / "1x1black.png", "rb").read())
+
+    arf = APIRequestFactory()
+    request = arf.get(PATH + f"?url={url}")
+    force_authenticate(request, admin_user)
+    view = MatchColour.as_view()
+    # occupy the only summarise slot so that the request would have to queue beyond its budget
+    with limiter.slot():
+        response = view(request)
+    assert response.status_code == 503
+    assert response["Retry-After"] == "3"
+    assert response.data == {"errors": ["Server is too busy to handle this request, please retry later"]}
+    # the request was shed before the image was fetched
+    assert not requests_mock.called
+
+
+@pytest.mark.django_db
+def test_view_overloaded_during_fetch(admin_user: User, settings: Settings, requests_mock: Mocker) -> None:
+    limiter = ConcurrencyLimiter(max_concurrency=1, latency_budget=1.0, initial_service_time=2.5)
+    setattr(settings, "SUMMARISE_LIMITER", limiter)
+    image_bytes = open(getattr(settings, "BASE_DIR") / "images" / "1x1black.png", "rb").read()
+
+    with ExitStack() as busy:
+
+        def fetch_while_getting_busy(request: Any, context: Any) -> bytes:
+            # another job takes the only summarise slot while we're fetching
+            busy.enter_context(limiter.slot())
+            return image_bytes
+
+        url = "http://test-colour-matching.test/1x1black.png"
+        requests_mock.get(url, content=fetch_while_getting_busy)
+
+        arf = APIRequestFactory()
+        request = arf.get(PATH + f"?url={url}")
+        force_authenticate(request, admin_user)
+        response = MatchColour.as_view()(request)
+    assert requests_mock.called
+    assert response.status_code == 503
+
+
+def test_throttle_history_shared_between_processes() -> None:
+    # a per-process cache would give each user the rate once per worker process
+    for throttle in (MatchColourThrottle, PaletteCoverageThrottle):
+        assert throttle.cache is caches["throttle"]
+        assert not isinstance(throttle.cache, LocMemCache)
+
+
+@pytest.mark.django_db
+def test_view_throttled(admin_user: User, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(MatchColourThrottle, "THROTTLE_RATES", {"match_colour": "1/minute"})
+    arf = APIRequestFactory()
+    view = MatchColour.as_view()
+    responses = []
+    for _ in range(2):
+        request = arf.get(PATH)
+        force_authenticate(request, admin_user)
+        responses.append(view(request))
+    assert responses[0].status_code == 400
+    assert responses[1].status_code == 429
+    assert "Retry-After" in responses[1]
+
+
+@pytest.mark.django_db
+def test_admission_status(admin_user: User) -> None:
+    arf = APIRequestFactory()
+    request = arf.get("/colours/admission")
+    force_authenticate(request, admin_user)
+    view = AdmissionStatus.as_view()
+    response = view(request)
+    assert response.status_code == 200
+    assert sorted(response.data.keys()) == ["coverage", "fetch", "summarise"]
+    for depth in response.data.values():
+        assert depth["in_flight"] == 0
+        assert depth["waiting"] == 0
+
+
+@pytest.mark.django_db
+def test_view_progressive_server_timing(admin_user: User, settings: Settings, requests_mock: Mocker) -> None:
+    setattr(settings, "COLOURS", TEST_COLOURS_SRGB)
+    setattr(settings, "COLOUR_MATCHERS", {"srgb": SRGBKDTreeColourMatcher(getattr(settings, "COLOURS"))})
+
+    url = "http://test-colour-matching.test/black-square-white-bg.png"
+    requests_mock.get(
+        url, content=open(getattr(settings, "BASE_DIR") / "images" / "black-square-white-bg.png", "rb").read()
+    )
+
+    arf = APIRequestFactory()
+    request = arf.get(PATH + f"?url={url}&summariser=progressive")
+    force_authenticate(request, admin_user)
+    view = MatchColour.as_view()
+    response = view(request)
+    assert response.status_code == 200
+    assert response.data["colour"] == "black"
+    assert re.fullmatch(r"tier16;dur=[0-9.]+(, tier\w+;dur=[0-9.]+)*", response["Server-Timing"])
+
+
+@pytest.mark.parametrize("staff", (True, False))
+@pytest.mark.django_db
+def test_view_profiled(
+    admin_user: User, settings: Settings, requests_mock: Mocker, tmp_path: Path, staff: bool
+) -> None:
+    setattr(settings, "REQUEST_PROFILER", RequestProfiler(tmp_path))
+    admin_user.is_staff = staff
+
+    url = "http://test-colour-matching.test/1x1black.png"
+    requests_mock.get(url, content=open(getattr(settings, "BASE_DIR") / "images" / "1x1black.png", "rb").read())
+
+    arf = APIRequestFactory()
+    request = arf.get(PATH + f"?url={url}", HTTP_X_PROFILE="memory")
+    force_authenticate(request, admin_user)
+    view = MatchColour.as_view()
+    response = view(request)
+    assert response.status_code == 200
+    assert len(list(tmp_path.glob("*-MatchColour-*.pstats"))) == (1 if staff else 0)
+
+
+@pytest.mark.parametrize(
+    "query,expected_errors",
+    (
+        ("", ["Please specify a 'url' query parameter"]),
+        ("?url=http://example.com&max_distance=0", ["Invalid max distance"]),
+        ("?url=http://example.com&max_distance=wharblgarbl", ["Invalid max distance"]),
+        ("?url=http://example.com&colour_space=wharblgarbl", ["Invalid colour space"]),
+        ("?url=http://example.com&max_size=0", ["Invalid max size"]),
+        ("?url=http://example.com&max_size=wharblgarbl", ["Invalid max size"]),
+        ("?url=http://example.com&bins=0", ["Invalid number of bins"]),
+        ("?url=file:///etc/passwd&bins=1000", ["Only http or https URLs are allowed", "Invalid number of bins"]),
+    ),
+)
+@pytest.mark.django_db
+def test_coverage_view_invalid(admin_user: User, query: str, expected_errors: List[str]) -> None:
+    arf = APIRequestFactory()
+    request = arf.get(COVERAGE_PATH + query)
+    force_authenticate(request, admin_user)
+    view = PaletteCoverage.as_view()
+    response = view(request)
+    assert response.status_code == 400
+    assert response.data == {"errors": expected_errors}
+
+
+@pytest.mark.parametrize("max_size", ("10", "full"))
+@pytest.mark.django_db
+def test_coverage_view(admin_user: User, settings: Settings, requests_mock: Mocker, max_size: str) -> None:
+    setattr(settings, "COLOURS", TEST_COLOURS_SRGB)
+    setattr(settings, "COLOUR_MATCHERS", {"srgb": SRGBKDTreeColourMatcher(getattr(settings, "COLOURS"))})
+
+    image = Image.new("RGB", (40, 20), (0, 0, 0))
+    image.paste((255, 255, 255), (0, 0, 10, 20))
+    image_file = BytesIO()
+    image.save(image_file, format="PNG")
+    url = "http://test-colour-matching.test/quarter-white.png"
+    requests_mock.get(url, content=image_file.getvalue())
+
+    arf = APIRequestFactory()
+    request = arf.get(COVERAGE_PATH + f"?url={url}&max_size={max_size}&bins=4")
+    force_authenticate(request, admin_user)
+    view = PaletteCoverage.as_view()
+    response = view(request)
+    assert response.status_code == 200
+    assert (response.data["width"], response.data["height"]) == ((10, 5) if max_size == "10" else (40, 20))
+    # scaling down blurs the edge between black and white a little
+    assert response.data["coverage"]["black"] == pytest.approx(0.75, abs=0.1)
+    assert response.data["coverage"]["white"] == pytest.approx(0.25, abs=0.1)
+    assert response.data["distances"]["bin_edges"] == pytest.approx([0.0, 0.05, 0.1, 0.15, 0.2])
+    assert sum(response.data["distances"]["counts"]) == response.data["width"] * response.data["height"]
+    assert response.data["distances"]["over_max_distance"] == 0
+
+
+@pytest.mark.django_db
+def test_coverage_view_invalid_image(admin_user: User, requests_mock: Mocker) -> None:
+    url = "http://test-colour-matching.test/not-an-image.png"
+    requests_mock.get(url, content=b"wharblgarbl")
+
+    arf = APIRequestFactory()
+    request = arf.get(COVERAGE_PATH + f"?url={url}")
+    force_authenticate(request, admin_user)
+    view = PaletteCoverage.as_view()
+    response = view(request)
+    assert response.status_code == 400
+    assert response.data == {"errors": ["Could not parse image"]}
+
+
+@pytest.mark.django_db
+def test_coverage_view_own_limiter(admin_user: User, settings: Settings, requests_mock: Mocker) -> None:
+    coverage_limiter = ConcurrencyLimiter(max_concurrency=1, latency_budget=1.0, initial_service_time=2.5)
+    summarise_limiter = ConcurrencyLimiter(max_concurrency=1, latency_budget=1.0, initial_service_time=2.5)
+    setattr(settings, "COVERAGE_LIMITER", coverage_limiter)
+    setattr(settings, "SUMMARISE_LIMITER", summarise_limiter)
+    url = "http://test-colour-matching.test/1x1black.png"
+    requests_mock.get(url, content=open(getattr(settings, "BASE_DIR") / "images" / "1x1black.png", "rb").read())
+
+    arf = APIRequestFactory()
+    view = PaletteCoverage.as_view()
+    # a busy match endpoint doesn't hold up coverage jobs
+    with summarise_limiter.slot():
+        request = arf.get(COVERAGE_PATH + f"?url={url}")
+        force_authenticate(request, admin_user)
+        assert view(request).status_code == 200
+        # and its time doesn't feed into the match endpoint's estimates
+        assert summarise_limiter.mean_service_time == 2.5
+    # but a busy coverage job does, before the image is fetched
+    requests_mock.reset_mock()
+    with coverage_limiter.slot():
+        request = arf.get(COVERAGE_PATH + f"?url={url}")
+        force_authenticate(request, admin_user)
+        response = view(request)
+    assert response.status_code == 503
+    assert not requests_mock.called